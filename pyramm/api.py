@@ -1,5 +1,9 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+from datetime import date
+from itertools import islice
 from time import sleep
-from typing import Optional
+from typing import Callable, Optional
 from requests import get, post
 from urllib.parse import urlencode
 from numpy import arange, ceil
@@ -11,14 +15,26 @@ from unsync import unsync
 from pyramm.cache import file_cache, freezeargs
 from pyramm.config import config
 from pyramm.constants import DEFAULT_SQLITE_PATH
-from pyramm.db import from_sqlite, to_sqlite, update_table_status_in_sqlite
+from pyramm.helpers import _frame_from_rows, _to_arrow
+from pyramm.jobs import PullProgress, RateLimiter
 from pyramm.logging import logger
+from pyramm.query import TableQuery
+from pyramm.store import (
+    BaseStore,
+    SqliteStore,
+    _require_pyarrow,
+    apply_filters,
+    combine_hashes,
+    content_hash,
+)
 from pyramm.tables import (
     SurfaceLayer,
     SurfaceMaterialType,
     SurfaceStructureCleaned,
     SurfaceStructureDetailed,
     TableSchema,
+    cast_to_schema,
+    store_indexes,
     Roadnames,
     Carrway,
     HsdRoughness,
@@ -44,9 +60,14 @@ class TableRemovedError(Exception):
     pass
 
 
+class LocalDataError(Exception):
+    pass
+
+
 class Connection:
     url = "https://apps.ramm.co.nz/RammApi6.1/v1"
     chunk_size = 2000
+    rate_limiter: Optional[RateLimiter] = None
 
     def __init__(
         self,
@@ -63,7 +84,30 @@ class Connection:
             "SKIP_TABLE_NAME_CHECK",
             fallback=environ.get("SKIP_TABLE_NAME_CHECK", False),
         ),
+        store: Optional[BaseStore] = None,
+        prefer_local: bool = False,
+        max_local_age_days: Optional[int] = None,
+        dtype_backend: Optional[str] = None,
     ):
+        """
+        Parameters
+        ----------
+        store: BaseStore
+            Local mirror used by `pull`. Defaults to a SqliteStore at sqlite_path.
+            Use a ParquetStore for a parquet dataset partitioned by road_id.
+        prefer_local: bool
+            Serve `get_data` (and the table helper methods) from the local store
+            where the table (or the requested road_ids) has been pulled. Falls back
+            to the RAMM API otherwise.
+        max_local_age_days: int
+            Only use local tables retrieved within this many days (according to the
+            local table status), defaults to no limit.
+        dtype_backend: str
+            Use "pyarrow" for DataFrames with Arrow-backed dtypes (requires
+            pyarrow). Applies to `get_data`, the table helper methods, the file
+            cache and reads from the local store. Defaults to NumPy-backed dtypes.
+
+        """
         if username is None:
             username, password = self._get_credentials()
 
@@ -71,14 +115,70 @@ class Connection:
             username=username, password=password, database=database
         )
 
-        self.database = database
-        self.sqlite_path = sqlite_path.absolute()
+        self._setup(
+            database,
+            sqlite_path,
+            store,
+            skip_table_name_check,
+            prefer_local,
+            max_local_age_days,
+            dtype_backend,
+        )
         self.headers = {
             "Content-type": "application/json",
             "referer": "https://test.com",
             "Authorization": f"Bearer {authorization_key}",
         }
+
+    def _setup(
+        self,
+        database,
+        sqlite_path,
+        store,
+        skip_table_name_check,
+        prefer_local,
+        max_local_age_days,
+        dtype_backend=None,
+    ):
+        if dtype_backend not in [None, "pyarrow"]:
+            raise ValueError("dtype_backend must be None or 'pyarrow'")
+        if dtype_backend == "pyarrow":
+            _require_pyarrow("Arrow-backed DataFrames")
+        self.database = database
+        self.sqlite_path = sqlite_path.absolute()
+        self.store = SqliteStore(self.sqlite_path, database) if store is None else store
         self.skip_table_name_check = skip_table_name_check
+        self.prefer_local = prefer_local
+        self.max_local_age_days = max_local_age_days
+        self.dtype_backend = dtype_backend
+        self.offline = False
+        self.headers = None
+
+    @classmethod
+    def local(
+        cls,
+        sqlite_path=DEFAULT_SQLITE_PATH,
+        database="SH New Zealand",
+        store: Optional[BaseStore] = None,
+        dtype_backend: Optional[str] = None,
+    ):
+        """
+        Create a Connection that serves all data from the local store (populated
+        using `pull`) without logging in to the RAMM API.
+
+        """
+        new = cls.__new__(cls)
+        new._setup(
+            database,
+            sqlite_path,
+            store,
+            skip_table_name_check=True,
+            prefer_local=True,
+            max_local_age_days=None,
+            dtype_backend=dtype_backend,
+        )
+        new.offline = True
+        return new
 
     @staticmethod
     def _get_credentials():
@@ -94,13 +194,26 @@ class Connection:
             return response.json()
         raise LoginError(response)
 
+    def _check_online(self):
+        if self.offline:
+            raise LoginError(
+                "not logged in to the RAMM API (connection created using "
+                "Connection.local)"
+            )
+
     def _get(self, endpoint):
+        self._check_online()
+        if self.rate_limiter is not None:
+            self.rate_limiter.wait()
         response = get(f"{self.url}/{endpoint}", headers=self.headers)
         if response.status_code == 200:
             return response.json()
         raise RequestError(response)
 
     def _post(self, endpoint, body):
+        self._check_online()
+        if self.rate_limiter is not None:
+            self.rate_limiter.wait()
         response = post(f"{self.url}/{endpoint}", headers=self.headers, json=body)
         if response.status_code == 200:
             return response.json()
@@ -139,6 +252,25 @@ class Connection:
     def _geometry_table(self, table_name):
         return len(self._query(table_name, get_geometry=True)["rows"]) > 0
 
+    def _get_page(self, table_name, filters, get_geometry, skip, take):
+        # Retrieve a single page of rows. All columns are retained (including
+        # columns without any values) so the pages of a table are consistent.
+        if self.rate_limiter is None:
+            sleep(1)
+        logger.debug(f"getting rows {skip:.0f} to {skip+take:.0f}")
+        response = self._query(
+            table_name,
+            filters=filters,
+            skip=skip,
+            take=take,
+            get_geometry=get_geometry,
+        )
+        return _frame_from_rows(
+            [rr["values"] for rr in response["rows"]],
+            response["columns"],
+            self.dtype_backend,
+        ).rename(columns={"geometry": "wkt"})
+
     @unsync
     def _get_data_partial(
         self,
@@ -151,25 +283,49 @@ class Connection:
     ):
         df = DataFrame()
         for skip in range(start_row, end_row, chunk_size):
-            sleep(1)
-            logger.debug(f"getting rows {skip:.0f} to {skip+chunk_size:.0f}")
-            response = self._query(
-                table_name,
-                filters=filters,
-                skip=skip,
-                take=chunk_size,
-                get_geometry=get_geometry,
-            )
-
-            df_ = DataFrame(
-                [rr["values"] for rr in response["rows"]],
-                columns=response["columns"],
-            )
+            df_ = self._get_page(table_name, filters, get_geometry, skip, chunk_size)
             valid_columns = [cc for cc in df_.columns if df_[cc].notnull().any()]
             df_ = df_[valid_columns]
             df = concat([df, df_], ignore_index=True)
 
-        return df.rename(columns={"geometry": "wkt"})
+        return df
+
+    def _iter_pages(self, table_name, filters=[], get_geometry=False, threads=1):
+        """
+        Yield the rows of a table one page (chunk_size rows) at a time. Up to
+        `threads` pages are requested concurrently, no more than `threads` pages
+        are retrieved ahead of the consumer. A single empty page is yielded if
+        there are no rows.
+
+        """
+        total_rows = self._rows(table_name, filters)
+        if total_rows == 0:
+            logger.info(f"no rows to retrieve from {table_name}")
+            column_names = list(self.column_names(table_name))
+            if get_geometry:
+                column_names.append("wkt")
+            yield DataFrame(columns=column_names)
+            return
+
+        logger.info(f"streaming {total_rows:.0f} rows from {table_name}")
+        skips = iter(range(0, total_rows, self.chunk_size))
+        with ThreadPoolExecutor(threads) as executor:
+
+            def request(skip):
+                return executor.submit(
+                    self._get_page,
+                    table_name,
+                    filters,
+                    get_geometry,
+                    skip,
+                    self.chunk_size,
+                )
+
+            pending = deque(request(skip) for skip in islice(skips, threads))
+            while pending:
+                page = pending.popleft().result()
+                pending.extend(request(skip) for skip in islice(skips, 1))
+                yield page
 
     def _get_data(self, table_name, filters=[], get_geometry=False, threads=4):
         """
@@ -211,9 +367,118 @@ class Connection:
         ]
         return concat([tt.result() for tt in tasks], ignore_index=True)
 
+    def _use_local(self, table_name, road_id):
+        # Decide whether a request can be served from the local store:
+        if not self.prefer_local:
+            return False
+
+        table_status = self.store.read_table_status()
+        if (
+            table_status is None
+            or (self.database, table_name) not in table_status.index
+        ):
+            return False
+        status = table_status.loc[(self.database, table_name)]
+
+        if self.max_local_age_days is not None:
+            age_days = (date.today() - status["date_retrieved"]).days
+            if age_days > self.max_local_age_days:
+                return False
+
+        if status["full_retrieval"]:
+            return True
+        if road_id is None:
+            return False
+
+        # Partial retrieval, check the requested road_ids are present locally:
+        road_ids = road_id if isinstance(road_id, list) else [road_id]
+        return set(int(rr) for rr in road_ids) <= self._complete_road_ids(table_name)
+
+    def _get_local_data(
+        self, table_name, road_id, latest, get_geometry, filters, columns=None
+    ):
+        road_ids = None
+        if road_id:
+            road_ids = road_id if isinstance(road_id, list) else [road_id]
+
+        filters = parse_filters(None, latest, filters)
+        if columns is not None:
+            # Also read the columns needed to apply the filters:
+            columns = list(columns) + [
+                ff["columnName"] for ff in filters if ff["columnName"] not in columns
+            ]
+            if get_geometry:
+                columns += ["wkt", "wkb"]
+
+        df = self.store.read(
+            table_name,
+            columns=columns,
+            road_ids=road_ids,
+            dtype_backend=self.dtype_backend,
+        )
+        if df is None:
+            raise LocalDataError(f"'{table_name}' is not available in the local store")
+
+        # The road_id filter has already been applied by the store:
+        df = apply_filters(df, filters)
+        if not get_geometry:
+            df = df.drop(columns=["wkt", "geometry"], errors="ignore")
+        return df.reset_index(drop=True)
+
+    def get_data(
+        self,
+        table_name: str,
+        road_id: Optional[int] = None,
+        latest: bool = False,
+        get_geometry: bool = False,
+        threads: int = 4,
+        filters=[],
+        columns: Optional[list[str]] = None,
+    ):
+        """
+        Retrieve a RAMM table from the local store (if preferred and available) or
+        the RAMM API.
+
+        Parameters
+        ----------
+        table_name : str
+            RAMM table name
+        road_id : int or list[int], optional
+            Limit the result to one or more road_ids
+        latest : bool
+            Only return the latest rows (latest == "L"), by default False
+        get_geometry : bool
+            Include the geometry ("wkt" column), by default False
+        threads : int
+            Number of threads used to retrieve the table from the API
+        filters : list
+            RAMM API filters, e.g.
+            {'columnName': 'latest', 'operator': 'EqualTo', 'value': 'L'}
+        columns : list[str], optional
+            Only return these columns. Only the requested columns are read from the
+            local store, the API always returns all columns.
+
+        """
+        if self.offline or self._use_local(table_name, road_id):
+            logger.debug(f"reading {table_name} from the local store")
+            df = self._get_local_data(
+                table_name, road_id, latest, get_geometry, filters, columns
+            )
+        else:
+            df = self._get_remote_data(
+                table_name, road_id, latest, get_geometry, threads, filters
+            )
+        if columns is not None:
+            geometry_columns = ["wkt", "geometry"] if get_geometry else []
+            df = df[[cc for cc in list(columns) + geometry_columns if cc in df.columns]]
+        if self.dtype_backend == "pyarrow":
+            # Any remaining NumPy-backed columns (e.g. empty tables):
+            df = _to_arrow(df)
+        return df
+
     # @lru_cache(maxsize=10)
     @file_cache()
-    def get_data(
+    def _get_remote_data(
         self,
         table_name: str,
         road_id: Optional[int] = None,
@@ -275,6 +540,7 @@ class Connection:
         skip_existing: bool = True,
         road_ids: list[int] | None = None,
         incremental_download: bool = False,
+        changed_only: bool = False,
     ) -> None:
         """Pulls the latest version of the table from the remote database.
 
@@ -283,22 +549,43 @@ class Connection:
         table_name : str
             RAMM table name
         skip_existing : bool, optional
-            Skip any road_ids that are already present in the local database, by default True
+            Skip any road_ids that are already present in the local store, by default True
         road_ids : list[int] | None, optional
             List of road_ids to pull. If None, pulls all road_ids. By default None.
         incremental_download : bool
             Download the table one road_id at a time, by default True. Only
             used where the source table contains a road_id column. Has no effect
             when the road_ids argument is used (always incremental download).
+        changed_only : bool
+            Only download the road_ids where the number of rows in the RAMM table
+            differs from the row count recorded in the local store, by default
+            False. Use with skip_existing=False to refresh a partial mirror.
         """
 
         logger.info(
-            "WARNING: local SQLite database functionality is still in "
+            "WARNING: local database functionality is still in "
             "development and is subject to change."
         )
 
+        road_ids, entire_table, local_hashes = self._plan_pull(
+            table_name, skip_existing, road_ids, incremental_download, changed_only
+        )
+
+        # Pages are streamed to the store, each page is downloaded while the previous
+        # page is written:
+        with ThreadPoolExecutor(self.store.write_threads) as writer:
+            for road_id in road_ids:
+                self._pull_unit(table_name, road_id, local_hashes, writer)
+
+        return self._finalise_pull(table_name, entire_table)
+
+    def _plan_pull(
+        self, table_name, skip_existing, road_ids, incremental_download, changed_only
+    ):
+        # Returns the road_ids to download (None for the entire table), whether the
+        # pull will result in a complete copy of the table and the content hashes
+        # of the road_ids already in the store.
         entire_table = road_ids is None
-        if_exists = "replace"
 
         if road_ids is None and not incremental_download:
             road_ids = [None]
@@ -306,66 +593,313 @@ class Connection:
             if "road_id" in self.column_names(table_name):
                 if road_ids is None:
                     road_ids = self.roadnames().index.to_list()
+                requested_road_ids = set(road_ids)
 
-                # Load the existing table from the local database, if present:
-                existing = from_sqlite(table_name, path=self.sqlite_path)
+                # Find the road_ids already present in the local database:
+                existing_road_ids = self.store.road_ids(table_name)
 
-                if existing is not None:
-                    existing_road_ids = existing["road_id"].unique()
+                if existing_road_ids is not None:
+                    existing_road_ids = set(existing_road_ids)
+                    complete_road_ids = self._complete_road_ids(table_name)
                     if skip_existing:
                         # Update the list of road_ids to retrieve to exclude any
-                        # road_ids already present in the local database:
+                        # road_ids already retrieved. Road_ids left incomplete by
+                        # a failed pull are retrieved again:
                         road_ids = [
-                            rr for rr in road_ids if rr not in existing_road_ids
+                            rr for rr in road_ids if rr not in complete_road_ids
                         ]
-                    else:
-                        # Drop any road_ids that are already present in the local
-                        # database:
-                        existing = existing.loc[
-                            ~existing["road_id"].isin(road_ids)
-                        ].copy()
-
-                        # Update the local database to remove the road_ids that
-                        # will be downloaded:
-                        to_sqlite(existing, table_name, path=self.sqlite_path)
-
-                    # If the existing table contains some row then mark this as a
-                    # partial download:
-                    entire_table = len(existing) == 0
-                    if_exists = "replace" if entire_table else "append"
+                    # The rows for these road_ids are replaced as each road_id is
+                    # downloaded, the remaining rows are left untouched:
+                    retained_road_ids = existing_road_ids - set(road_ids)
+
+                    # If the existing table retains some rows then mark this as a
+                    # partial download, unless the pull covers every road_id and
+                    # the rows retained are complete (e.g. resuming a failed pull):
+                    entire_table = len(retained_road_ids) == 0 or (
+                        entire_table
+                        and retained_road_ids <= complete_road_ids & requested_road_ids
+                    )
             else:
                 # Set the road_ids variable so it can be used in the for loop:
                 road_ids = [None]
 
-        for road_id in road_ids:
-            logger.info(f"pulling {table_name} (road_id: {road_id})")
-            new = self.get_data(
-                table_name,
-                road_id=road_id,
-                get_geometry=self._geometry_table(table_name),
-                filters=[],
+        road_id_status = self.store.read_road_id_status(table_name)
+        if changed_only and road_id_status is not None and road_ids != [None]:
+            # Compare the server row counts with the local row counts:
+            local_counts = road_id_status["row_count"].to_dict()
+            road_ids = [
+                rr
+                for rr in road_ids
+                if self._rows(table_name, parse_filters(rr)) != local_counts.get(rr)
+            ]
+        local_hashes = {}
+        if road_id_status is not None:
+            # Only road_ids that are still present in the store can be left as is:
+            present = set(self.store.road_ids(table_name) or [])
+            local_hashes = {
+                rr: hh
+                for rr, hh in road_id_status["content_hash"].items()
+                if rr in present
+            }
+
+        return road_ids, entire_table, local_hashes
+
+    def _complete_road_ids(self, table_name):
+        # The road_ids present in the store whose status has been recorded, i.e.
+        # whose last pull completed. Tables without any road_id status (e.g.
+        # loaded using from_csv) fall back to the road_ids present.
+        present = set(self.store.road_ids(table_name) or [])
+        road_id_status = self.store.read_road_id_status(table_name)
+        if road_id_status is None or len(road_id_status) == 0:
+            return present
+        return present & set(road_id_status.index)
+
+    def _finalise_pull(self, table_name, entire_table):
+        self.store.finalise(table_name, store_indexes(table_name))
+        return self.store.update_table_status(
+            table_name, entire_table, source_total=self._rows(table_name)
+        )
+
+    def pull_many(
+        self,
+        tables: list[str],
+        workers: int = 4,
+        skip_existing: bool = True,
+        incremental_download: bool = True,
+        changed_only: bool = False,
+        requests_per_second: Optional[float] = None,
+        retries: int = 2,
+        progress: Optional[Callable[[PullProgress], None]] = None,
+    ) -> list:
+        """Pulls several tables from the remote database in parallel.
+
+        Each table (or each road_id of a table) is a unit of work. The units are
+        downloaded by a pool of workers, all writes go through the store's writer
+        threads (a single writer for SQLite).
+
+        Parameters
+        ----------
+        tables : list[str]
+            RAMM table names
+        workers : int, optional
+            Number of units downloaded at the same time, by default 4
+        skip_existing, incremental_download, changed_only :
+            See `pull`. incremental_download defaults to True.
+        requests_per_second : float, optional
+            Limit on the rate of API requests shared by all workers, by default no
+            limit
+        retries : int, optional
+            Number of times failed units are retried, by default 2
+        progress : Callable[[PullProgress], None], optional
+            Called with the job progress each time a unit completes
+
+        Returns
+        -------
+        list
+            (table_name, road_id) units that could not be pulled. The rows of a
+            unit that fails part way through are removed from the store, so
+            calling pull_many again with skip_existing=True resumes the job by
+            pulling only the failed units.
+        """
+        plans = {
+            table_name: self._plan_pull(
+                table_name, skip_existing, None, incremental_download, changed_only
             )
-            to_sqlite(
-                new,
-                table_name,
-                path=self.sqlite_path,
-                if_exists=if_exists,
+            for table_name in tables
+        }
+        pending = [
+            (table_name, road_id)
+            for table_name, (road_ids, _, _) in plans.items()
+            for road_id in road_ids
+        ]
+        job_progress = PullProgress(units_total=len(pending))
+
+        rate_limiter = self.rate_limiter
+        if requests_per_second is not None:
+            self.rate_limiter = RateLimiter(requests_per_second)
+        try:
+            with ThreadPoolExecutor(
+                self.store.write_threads
+            ) as writer, ThreadPoolExecutor(workers) as pool:
+                for attempt in range(retries + 1):
+                    if attempt > 0:
+                        logger.info(f"retrying {len(pending)} failed units")
+                        job_progress.retry()
+                    futures = {
+                        pool.submit(
+                            self._pull_unit,
+                            table_name,
+                            road_id,
+                            plans[table_name][2],
+                            writer,
+                        ): (table_name, road_id)
+                        for table_name, road_id in pending
+                    }
+                    pending = []
+                    for future in as_completed(futures):
+                        try:
+                            job_progress.update(rows=future.result())
+                        except Exception as exc:
+                            logger.warning(f"failed to pull {futures[future]}: {exc}")
+                            pending.append(futures[future])
+                            job_progress.update(failed=True)
+                        if progress is not None:
+                            progress(job_progress)
+                    if len(pending) == 0:
+                        break
+        finally:
+            self.rate_limiter = rate_limiter
+
+        failed_tables = {table_name for table_name, _ in pending}
+        for table_name, (_, entire_table, _) in plans.items():
+            self._finalise_pull(
+                table_name, entire_table and table_name not in failed_tables
             )
 
-        return update_table_status_in_sqlite(
-            self.database,
+        return pending
+
+    def _pull_unit(self, table_name, road_id, local_hashes, writer):
+        # Stream a table (road_id None) or the rows of a road_id to the store and
+        # return the number of rows retrieved.
+        logger.info(f"pulling {table_name} (road_id: {road_id})")
+        pages = self._iter_pages(
+            table_name,
+            filters=parse_filters(road_id),
+            get_geometry=self._geometry_table(table_name),
+            threads=4 if road_id is None else 1,
+        )
+        schema = self._pull_schema(table_name)
+        if schema is not None:
+            # The table is created from the first page, cast the pages so that the
+            # column types don't depend on the values in that page:
+            pages = (cast_to_schema(pp, schema) for pp in pages)
+        page = next(pages)
+        following = next(pages, None)
+        if following is None:
+            # Everything fits in a single page, the write can be skipped if the
+            # content is unchanged. Wait for the write so that errors are reported
+            # against this unit:
+            writer.submit(
+                self._write_to_store, page, table_name, road_id, local_hashes
+            ).result()
+            return len(page)
+
+        # Waiting for the previous write before submitting the next page provides
+        # backpressure, limiting memory use to a couple of pages per unit:
+        status = {}
+        rows = len(page)
+        write = writer.submit(self._write_page, page, table_name, road_id, True, status)
+        page = following
+        del following
+        try:
+            while page is not None:
+                write.result()
+                write = writer.submit(
+                    self._write_page, page, table_name, road_id, False, status
+                )
+                rows += len(page)
+                page = next(pages, None)
+            write.result()
+            # Like the pages, the status is written by the store's writer threads:
+            writer.submit(self._write_unit_status, table_name, road_id, status).result()
+        except Exception:
+            # Don't leave part of the rows in the store, wait for the page being
+            # written then remove the rows written so far:
+            wait([write])
+            writer.submit(self._discard_unit, table_name, road_id).result()
+            raise
+        return rows
+
+    def _write_unit_status(self, table_name, road_id, status):
+        # Record the row counts and content hashes accumulated by _write_page:
+        self.store.update_road_id_status(
             table_name,
-            entire_table,
-            path=self.sqlite_path,
+            [
+                {"road_id": rr, "row_count": cc, "content_hash": combine_hashes(hh)}
+                for rr, (cc, hh) in status.items()
+            ],
+            replace_all=road_id is None,
         )
 
+    def _write_page(self, df, table_name, road_id, first, status):
+        # The first page replaces the table (or the rows for the road_id), the
+        # following pages are appended. The row counts and content hashes of each
+        # road_id are accumulated in status.
+        # The status is only recorded once the last page has been written, until
+        # then the table (or road_id) is marked as incomplete.
+        if not first:
+            self.store.append(df, table_name)
+        elif road_id is None:
+            self.store.update_table_status(table_name, False)
+            self.store.update_road_id_status(table_name, [], replace_all=True)
+            self.store.write(df, table_name)
+        else:
+            self.store.delete_road_id_status(table_name, [road_id])
+            self.store.replace_road_ids(df, table_name, [road_id])
+
+        if road_id is not None:
+            groups = [(road_id, df)]
+        else:
+            groups = df.groupby("road_id") if "road_id" in df.columns else []
+        for rr in _road_id_status_records(groups):
+            row_count, hashes = status.setdefault(rr["road_id"], (0, []))
+            hashes.append(rr["content_hash"])
+            status[rr["road_id"]] = (row_count + rr["row_count"], hashes)
+
+    def _pull_schema(self, table_name):
+        try:
+            return self.table_schema(table_name)
+        except Exception as exc:
+            logger.debug(f"no schema available for {table_name}: {exc}")
+            return None
+
+    def _discard_unit(self, table_name, road_id):
+        # Remove the rows of a road_id that failed part way through. A table that
+        # failed part way through is already marked as incomplete.
+        if road_id is not None:
+            self.store.replace_road_ids(
+                DataFrame(columns=["road_id"]), table_name, [road_id]
+            )
+
+    def _write_to_store(self, df, table_name, road_id, local_hashes={}):
+        if road_id is None:
+            # Entire table:
+            self.store.write(df, table_name)
+            groups = df.groupby("road_id") if "road_id" in df.columns else []
+            self.store.update_road_id_status(
+                table_name, _road_id_status_records(groups), replace_all=True
+            )
+            return
+
+        records = _road_id_status_records([(road_id, df)])
+        if local_hashes.get(road_id) == records[0]["content_hash"]:
+            # Unchanged since the last pull, only update the status:
+            logger.debug(f"{table_name} (road_id: {road_id}) is unchanged")
+        else:
+            # Replace only the rows for this road_id:
+            self.store.replace_road_ids(df, table_name, [road_id])
+        self.store.update_road_id_status(table_name, records)
+
+    def table(self, table_name: str) -> TableQuery:
+        """
+        Return a lazy handle to a RAMM table. Conditions and column selections are
+        added using where() and select() and the query is only executed by
+        collect() or iter(), e.g.
+
+            conn.table("hsd_rough").where(road_id=[1715], latest=True).collect()
+
+        """
+        return TableQuery(self, table_name)
+
     @lru_cache(maxsize=10)
     def column_names(self, table_name):
         return self._query(table_name)["columns"]
 
     @lru_cache(maxsize=10)
+    @file_cache("schema")
     def table_schema(self, table_name):
-        # Returns the RAMM schema details for a given table:
+        # Returns the RAMM schema details for a given table (cached like the table
+        # data, so loading a cached table doesn't request the schema):
         return TableSchema.from_schema(self._get(f"schema/{table_name}?loadType=3"))
 
     @lru_cache(maxsize=1)
@@ -471,9 +1005,17 @@ class Connection:
         return SkidResistance(self, road_id, latest, survey_year).df
 
 
+def _road_id_status_records(groups):
+    return [
+        {"road_id": road_id, "row_count": len(gg), "content_hash": content_hash(gg)}
+        for road_id, gg in groups
+    ]
+
+
 def parse_filters(road_id=None, latest=False, filters: list = None):
-    if filters is None:
-        filters = []
+    # Returns a new list, the filters passed in are shared between requests (e.g.
+    # the road_ids of a query retrieved in parallel) so they aren't modified:
+    filters = [] if filters is None else list(filters)
     if latest:
         filters.append({"columnName": "latest", "operator": "EqualTo", "value": "L"})
     if road_id:
@@ -3,6 +3,7 @@ import pickle
 
 import pandas as pd
 
+from concurrent.futures import ThreadPoolExecutor
 from copy import copy
 from datetime import datetime
 from frozendict import frozendict
@@ -11,6 +12,7 @@ from pathlib import Path
 from tempfile import gettempdir
 
 
+from pyramm.config import config
 from pyramm.version import __version__
 from pyramm.logging import logger
 
@@ -18,6 +20,17 @@ from pyramm.logging import logger
 TEMP_DIRECTORY = Path(gettempdir()).joinpath("pyramm")
 DEFAULT_SQLITE_PATH = Path().home() / "pyramm.sqlite"
 
+# Tables (or Connection helper methods) loaded into the file cache by prewarm().
+# Derived objects are built after the tables they depend on have been cached.
+DEFAULT_PREWARM_TABLES = [
+    "roadnames",
+    "carr_way",
+    "hsd_roughness_hdr",
+    "hsd_rutting_hdr",
+    "hsd_texture_hdr",
+]
+DEFAULT_PREWARM_DERIVED = ["centreline"]
+
 
 def setup_temp_directory():
     TEMP_DIRECTORY.mkdir(exist_ok=True)
@@ -43,6 +56,9 @@ def generate_cache_file_path(name=None, func_args=[], func_kwargs={}):
         # the list of arguments:
         if type(args[0]).__name__ == "Connection":
             kwargs["database"] = args[0].database
+            if getattr(args[0], "dtype_backend", None) is not None:
+                # Keep Arrow-backed results separate from NumPy-backed results:
+                kwargs["dtype_backend"] = args[0].dtype_backend
             args = args[1:]
 
     return TEMP_DIRECTORY.joinpath(
@@ -67,7 +83,15 @@ def file_cache(name=None):
                     return pickle.load(cache_file_path.open("rb"))
 
                 result = func(*args, **kwargs)
-                pickle.dump(result, cache_file_path.open("wb"))
+
+                # Write to a temporary file first so that other processes never
+                # read a partially written cache file:
+                temp_file_path = cache_file_path.with_name(
+                    f"{cache_file_path.name}.{os.getpid()}.tmp"
+                )
+                with temp_file_path.open("wb") as f:
+                    pickle.dump(result, f)
+                os.replace(temp_file_path, cache_file_path)
                 return result
 
             except Exception:
@@ -81,6 +105,74 @@ def file_cache(name=None):
 setup_temp_directory()
 
 
+def _configured_prewarm_tables():
+    tables = config().get("PREWARM", "TABLES", fallback=None)
+    if tables is None:
+        return DEFAULT_PREWARM_TABLES + DEFAULT_PREWARM_DERIVED
+    return [tt.strip() for tt in tables.split(",") if tt.strip()]
+
+
+def _prewarm_single(conn, name):
+    # Use the Connection helper method where one exists (e.g. "roadnames",
+    # "centreline"), otherwise treat the name as a RAMM table name:
+    method = getattr(conn, name, None)
+    if callable(method):
+        method()
+    else:
+        conn.get_data(name)
+    return name
+
+
+def prewarm(conn, tables: list = None, workers: int = 4) -> list:
+    """Load tables and derived objects into the file cache ahead of a workload.
+
+    The tables are retrieved in parallel. Derived objects (e.g. "centreline") are
+    built once the tables they depend on are cached.
+
+    Parameters
+    ----------
+    conn : Connection
+        RAMM API connection.
+    tables : list, optional
+        Connection helper method names (e.g. "roadnames", "hsd_roughness_hdr",
+        "centreline") or RAMM table names. Defaults to the TABLES entry in the
+        [PREWARM] section of the config file (comma separated) or, if not set,
+        DEFAULT_PREWARM_TABLES + DEFAULT_PREWARM_DERIVED.
+    workers : int
+        Number of tables retrieved at the same time. The tables are retrieved on
+        a dedicated thread pool, the page requests of each table use the shared
+        unsync pool.
+
+    Returns
+    -------
+    list
+        Names that could not be loaded into the cache.
+    """
+    if tables is None:
+        tables = _configured_prewarm_tables()
+
+    stages = [
+        [tt for tt in tables if tt not in DEFAULT_PREWARM_DERIVED],
+        [tt for tt in tables if tt in DEFAULT_PREWARM_DERIVED],
+    ]
+
+    failed = []
+    with ThreadPoolExecutor(workers) as executor:
+        for names in stages:
+            tasks = {
+                name: executor.submit(_prewarm_single, conn, name) for name in names
+            }
+            for name, task in tasks.items():
+                try:
+                    task.result()
+                    logger.info(f"prewarmed {name}")
+                except Exception as exc:
+                    logger.warning(f"failed to prewarm {name}: {exc}")
+                    failed.append(name)
+
+    return failed
+
+
 def freezeargs(func):
     """
     Transform mutable dictionnary into immutable.
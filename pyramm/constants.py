@@ -2,3 +2,4 @@ from pathlib import Path
 
 
 DEFAULT_SQLITE_PATH = Path.home() / "pyramm.sqlite"
+DEFAULT_PARQUET_PATH = Path.home() / "pyramm_parquet"
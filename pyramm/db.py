@@ -1,10 +1,136 @@
 from contextlib import suppress
 import pandas as pd
+import shapely
 from datetime import date
-from sqlalchemy import create_engine
+from functools import lru_cache
+from sqlalchemy import bindparam, create_engine, event, inspect, text
 from sqlalchemy.exc import OperationalError
 
 from pyramm.constants import DEFAULT_SQLITE_PATH
+from pyramm.geometry import transform_array, transform_coords
+from pyramm.helpers import _to_arrow
+
+
+# Connection settings applied to every SQLite connection. WAL allows readers to
+# continue while a pull is writing and NORMAL synchronous is safe in WAL mode.
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "cache_size": -64000,  # 64 MB
+    "temp_store": "MEMORY",
+}
+WRITE_BATCH_SIZE = 10000
+
+# Geometry retrieved from RAMM is WGS84 (EPSG:4326):
+SOURCE_CRS = 4326
+
+
+@lru_cache(maxsize=None)
+def _engine(path):
+    engine = create_engine(f"sqlite:///{path}")
+
+    @event.listens_for(engine, "connect")
+    def _set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for kk, vv in SQLITE_PRAGMAS.items():
+            cursor.execute(f"PRAGMA {kk}={vv};")
+        cursor.close()
+
+    return engine
+
+
+def get_engine(path=DEFAULT_SQLITE_PATH):
+    """Return the (shared) SQLAlchemy engine for a SQLite database path."""
+    return _engine(path.absolute())
+
+
+def _quote(name):
+    return '"{}"'.format(name.replace('"', '""'))
+
+
+def _rtree_name(table_name):
+    return f"{table_name}_rtree"
+
+
+def _build_select(
+    table_name,
+    columns=None,
+    road_ids=None,
+    start_m=None,
+    end_m=None,
+    distinct=False,
+    bbox=None,
+):
+    # Build a parameterised SELECT statement for the requested columns and filters:
+    column_str = "*" if columns is None else ", ".join(_quote(cc) for cc in columns)
+    sql = f"SELECT {'DISTINCT ' if distinct else ''}{column_str} FROM {_quote(table_name)}"
+
+    conditions, params, expanding = [], {}, []
+    if road_ids is not None:
+        conditions.append("road_id IN :road_ids")
+        params["road_ids"] = [int(rr) for rr in road_ids]
+        expanding.append(bindparam("road_ids", expanding=True))
+    if start_m is not None:
+        conditions.append("end_m > :start_m")
+        params["start_m"] = float(start_m)
+    if end_m is not None:
+        conditions.append("start_m < :end_m")
+        params["end_m"] = float(end_m)
+    if bbox is not None:
+        # Use the R-tree index to find the features that intersect the bounding box:
+        conditions.append(
+            f"rowid IN (SELECT id FROM {_quote(_rtree_name(table_name))} "
+            "WHERE maxx >= :minx AND minx <= :maxx AND maxy >= :miny AND miny <= :maxy)"
+        )
+        params.update(zip(["minx", "miny", "maxx", "maxy"], map(float, bbox)))
+
+    if conditions:
+        sql += " WHERE " + " AND ".join(conditions)
+
+    return text(sql + ";").bindparams(*expanding), params
+
+
+def _geometry_crs(connection, table_name):
+    # Return the CRS of the WKB geometry stored for a table (None if the table
+    # doesn't contain WKB geometry):
+    if not inspect(connection).has_table("_geometry_columns"):
+        return None
+    return connection.execute(
+        text("SELECT crs FROM _geometry_columns WHERE table_name = :table_name;"),
+        {"table_name": table_name},
+    ).scalar()
+
+
+def _transform_bbox(bbox, from_crs, to_crs):
+    minx, miny, maxx, maxy = bbox
+    x, y = transform_coords(
+        [minx, minx, maxx, maxx], [miny, maxy, miny, maxy], from_crs, to_crs
+    )
+    return x.min(), y.min(), x.max(), y.max()
+
+
+def _process_sqlite_frame(df, date_columns, index_columns, crs=None, to_arrow=False):
+    if "wkb" in df.columns:
+        # Decode the WKB geometry, the CRS is recorded in the DataFrame attributes:
+        df["geometry"] = shapely.from_wkb(
+            df.pop("wkb").to_numpy(dtype=object, na_value=None)
+        )
+        df.attrs["crs"] = crs
+    for cc in date_columns:
+        try:
+            df[cc] = pd.to_datetime(df[cc]).dt.date
+        except KeyError:
+            pass
+    if to_arrow:
+        df = _to_arrow(df)
+    if index_columns:
+        df.set_index(index_columns, inplace=True)
+    return df
+
+
+def table_exists_in_sqlite(table_name, path=DEFAULT_SQLITE_PATH):
+    engine = get_engine(path)
+    return inspect(engine).has_table(table_name)
 
 
 def from_sqlite(
@@ -12,47 +138,344 @@ def from_sqlite(
     path=DEFAULT_SQLITE_PATH,
     date_columns=[],
     index_columns=[],
+    columns=None,
+    road_id=None,
+    road_ids=None,
+    start_m=None,
+    end_m=None,
+    chunksize=None,
+    bbox=None,
+    bbox_crs=None,
+    dtype_backend=None,
 ):
+    """
+    Read a table from the local SQLite database. Returns None if the table doesn't
+    exist.
+
+    Tables stored with WKB geometry are returned with a shapely "geometry" column,
+    the CRS of the geometry is available from df.attrs["crs"].
+
+    The column selection and filters are applied in the SQL query so that only the
+    requested rows are loaded:
+
+    :param columns: list of columns to load, defaults to all columns
+    :param road_id: load only the rows for a single road_id
+    :param road_ids: load only the rows for a list of road_ids
+    :param start_m: load only rows with end_m greater than start_m
+    :param end_m: load only rows with start_m less than end_m
+    :param chunksize: if provided, an iterator of DataFrames with up to chunksize
+        rows each is returned instead of a single DataFrame
+    :param bbox: load only features whose bounding box intersects
+        (minx, miny, maxx, maxy), uses the R-tree index maintained by SqliteWriter
+    :param bbox_crs: CRS of bbox, defaults to the CRS of the stored geometry
+    :param dtype_backend: use "pyarrow" for Arrow-backed dtypes
+
+    """
+    if road_id is not None:
+        road_ids = [road_id] + list(road_ids or [])
+
     with suppress(OperationalError):
-        engine = create_engine(f"sqlite:///{path.absolute()}")
-        df = pd.read_sql(
-            f"SELECT * FROM {table_name};", engine, parse_dates=[date_columns]
-        )
-        for cc in date_columns:
-            try:
-                df[cc] = pd.to_datetime(df[cc]).dt.date
-            except KeyError:
-                pass
-        if index_columns:
-            df.set_index(index_columns, inplace=True)
-        return df
+        engine = get_engine(path)
+        if not inspect(engine).has_table(table_name):
+            return None
+
+        with engine.connect() as connection:
+            crs = _geometry_crs(connection, table_name)
+        if columns is not None:
+            # Ignore requested columns that aren't present in the table:
+            existing = {cc["name"] for cc in inspect(engine).get_columns(table_name)}
+            columns = [cc for cc in columns if cc in existing]
+        if bbox is not None:
+            if crs is None:
+                raise ValueError(f"'{table_name}' has no spatial index")
+            if bbox_crs is not None and bbox_crs != crs:
+                bbox = _transform_bbox(bbox, bbox_crs, crs)
+
+        query, params = _build_select(
+            table_name, columns, road_ids, start_m, end_m, bbox=bbox
+        )
+        parse_dates = [cc for cc in date_columns if columns is None or cc in columns]
+        # The WKB geometry can't be read into an Arrow string column, so tables
+        # with geometry are converted to Arrow dtypes once it has been decoded:
+        to_arrow = dtype_backend == "pyarrow" and crs is not None
+        kwargs = {}
+        if dtype_backend is not None and not to_arrow:
+            kwargs = {"dtype_backend": dtype_backend}
+        result = pd.read_sql(
+            query,
+            engine,
+            params=params,
+            parse_dates=parse_dates,
+            chunksize=chunksize,
+            **kwargs,
+        )
+        if chunksize is not None:
+            return (
+                _process_sqlite_frame(df, date_columns, index_columns, crs, to_arrow)
+                for df in result
+            )
+        return _process_sqlite_frame(result, date_columns, index_columns, crs, to_arrow)
+    return None
+
+
+def road_ids_in_sqlite(table_name, path=DEFAULT_SQLITE_PATH):
+    """
+    Return the distinct road_ids present in a table in the local SQLite database, or
+    None if the table doesn't exist.
+
+    """
+    with suppress(OperationalError):
+        engine = get_engine(path)
+        if not inspect(engine).has_table(table_name):
+            return None
+        query, params = _build_select(table_name, ["road_id"], distinct=True)
+        with engine.connect() as connection:
+            return [rr[0] for rr in connection.execute(query, params)]
     return None
 
 
+class SqliteWriter:
+    """
+    Writes DataFrames to a local SQLite database. Rows are inserted in batches
+    (executemany) inside a single explicit transaction per write, using the engine
+    shared by all writers for the same database path.
+
+    With geometry_format="wkb", the "wkt" column is stored as WKB in a "wkb" column
+    (reprojected to geometry_crs) and an R-tree index of the feature bounding boxes
+    is maintained in the "<table_name>_rtree" virtual table.
+
+    """
+
+    def __init__(
+        self,
+        path=DEFAULT_SQLITE_PATH,
+        batch_size=WRITE_BATCH_SIZE,
+        geometry_format="wkb",
+        geometry_crs=SOURCE_CRS,
+    ):
+        if geometry_format not in ["wkt", "wkb"]:
+            raise ValueError("geometry_format must be 'wkt' or 'wkb'")
+        self.path = path
+        self.batch_size = batch_size
+        self.geometry_format = geometry_format
+        self.geometry_crs = geometry_crs
+        self.engine = get_engine(path)
+
+    def _to_wkb(self, df):
+        wkt = df["wkt"].to_numpy(dtype=object, na_value=None)
+        wkt[wkt == ""] = None
+        geometry = shapely.from_wkt(wkt, on_invalid="ignore")
+        if self.geometry_crs != SOURCE_CRS:
+            geometry = transform_array(geometry, SOURCE_CRS, self.geometry_crs)
+        df = df.drop(columns="wkt")
+        df["wkb"] = shapely.to_wkb(geometry)
+        return df
+
+    def _insert(self, connection, df, table_name, if_exists):
+        use_wkb = self.geometry_format == "wkb" and "wkt" in df.columns
+        if use_wkb:
+            df = self._to_wkb(df)
+
+        exists = inspect(connection).has_table(table_name)
+        if if_exists == "replace":
+            self._unregister_geometry(connection, table_name)
+        last_rowid = 0
+        if exists and if_exists == "append":
+            last_rowid = connection.execute(
+                text(f"SELECT max(rowid) FROM {_quote(table_name)};")
+            ).scalar()
+
+        df.to_sql(
+            table_name,
+            connection,
+            if_exists=if_exists,
+            index=False,
+            chunksize=self.batch_size,
+        )
+
+        if use_wkb:
+            self._register_geometry(connection, table_name)
+            self._update_rtree(connection, table_name, last_rowid or 0)
+
+    @staticmethod
+    def _unregister_geometry(connection, table_name):
+        connection.execute(
+            text(f"DROP TABLE IF EXISTS {_quote(_rtree_name(table_name))};")
+        )
+        if inspect(connection).has_table("_geometry_columns"):
+            connection.execute(
+                text("DELETE FROM _geometry_columns WHERE table_name = :table_name;"),
+                {"table_name": table_name},
+            )
+
+    def _register_geometry(self, connection, table_name):
+        connection.execute(
+            text(
+                "CREATE TABLE IF NOT EXISTS _geometry_columns "
+                "(table_name TEXT PRIMARY KEY, column_name TEXT, crs INTEGER);"
+            )
+        )
+        connection.execute(
+            text(
+                "INSERT OR REPLACE INTO _geometry_columns VALUES "
+                "(:table_name, 'wkb', :crs);"
+            ),
+            {"table_name": table_name, "crs": self.geometry_crs},
+        )
+
+    def _update_rtree(self, connection, table_name, last_rowid):
+        # Add the bounding boxes of the rows inserted after last_rowid:
+        rtree = _quote(_rtree_name(table_name))
+        connection.execute(
+            text(
+                f"CREATE VIRTUAL TABLE IF NOT EXISTS {rtree} "
+                "USING rtree(id, minx, maxx, miny, maxy);"
+            )
+        )
+        rows = connection.execute(
+            text(
+                f"SELECT rowid, wkb FROM {_quote(table_name)} "
+                "WHERE rowid > :last_rowid AND wkb IS NOT NULL;"
+            ),
+            {"last_rowid": last_rowid},
+        ).fetchall()
+        if len(rows) == 0:
+            return
+
+        rowids, wkb = zip(*rows)
+        bounds = shapely.bounds(shapely.from_wkb(list(wkb)))
+        valid = ~pd.isnull(bounds).any(axis=1)
+        connection.execute(
+            text(f"INSERT INTO {rtree} VALUES (:id, :minx, :maxx, :miny, :maxy);"),
+            [
+                {"id": ii, "minx": bb[0], "maxx": bb[2], "miny": bb[1], "maxy": bb[3]}
+                for ii, bb in zip(pd.Series(rowids)[valid], bounds[valid].tolist())
+            ],
+        )
+
+    def write(self, df, table_name, if_exists="replace"):
+        with self.engine.begin() as connection:
+            self._insert(connection, df, table_name, if_exists)
+
+    def replace_road_ids(self, df, table_name, road_ids):
+        """
+        Replace the rows for the given road_ids with the rows in df. The delete and
+        insert are carried out in a single transaction and only touch the rows for
+        the affected road_ids. The table is created if it doesn't already exist.
+
+        """
+        with self.engine.begin() as connection:
+            if inspect(connection).has_table(table_name):
+                self._create_index(connection, table_name, ["road_id"])
+                params = {"road_ids": [int(rr) for rr in road_ids]}
+                condition = "WHERE road_id IN :road_ids"
+                if inspect(connection).has_table(_rtree_name(table_name)):
+                    connection.execute(
+                        text(
+                            f"DELETE FROM {_quote(_rtree_name(table_name))} WHERE id IN "
+                            f"(SELECT rowid FROM {_quote(table_name)} {condition});"
+                        ).bindparams(bindparam("road_ids", expanding=True)),
+                        params,
+                    )
+                connection.execute(
+                    text(f"DELETE FROM {_quote(table_name)} {condition};").bindparams(
+                        bindparam("road_ids", expanding=True)
+                    ),
+                    params,
+                )
+            self._insert(connection, df, table_name, "append")
+            self._create_index(connection, table_name, ["road_id"])
+
+    @staticmethod
+    def _create_index(connection, table_name, columns):
+        index_name = "_".join(["ix", table_name] + list(columns))
+        connection.execute(
+            text(
+                f"CREATE INDEX IF NOT EXISTS {_quote(index_name)} "
+                f"ON {_quote(table_name)} ({', '.join(_quote(cc) for cc in columns)});"
+            )
+        )
+
+    def create_indexes(self, table_name, indexes):
+        """
+        Create indexes on a table. indexes is a list where each entry is a column
+        name or a list of column names (composite index). Indexes referring to
+        columns that are not present in the table are skipped.
+
+        """
+        with self.engine.begin() as connection:
+            if not inspect(connection).has_table(table_name):
+                return
+            table_columns = {
+                cc["name"] for cc in inspect(connection).get_columns(table_name)
+            }
+            for columns in indexes:
+                columns = [columns] if isinstance(columns, str) else list(columns)
+                if columns and set(columns) <= table_columns:
+                    self._create_index(connection, table_name, columns)
+
+
 def to_sqlite(
     df,
     table_name,
     path=DEFAULT_SQLITE_PATH,
     if_exists="replace",
 ):
-    engine = create_engine(f"sqlite:///{path.absolute()}")
-    df.to_sql(
-        table_name,
-        engine,
-        if_exists=if_exists,
-        index=False,
+    SqliteWriter(path).write(df, table_name, if_exists=if_exists)
+
+
+def replace_road_ids_in_sqlite(
+    df,
+    table_name,
+    road_ids,
+    path=DEFAULT_SQLITE_PATH,
+):
+    SqliteWriter(path).replace_road_ids(df, table_name, road_ids)
+
+
+def _create_status_tables(connection):
+    # Create the status tables, or add the columns introduced since the table was
+    # created:
+    connection.execute(
+        text(
+            "CREATE TABLE IF NOT EXISTS _table_status (database TEXT, table_name TEXT, "
+            "full_retrieval BOOLEAN, date_retrieved DATE, row_count INTEGER, "
+            "source_total INTEGER);"
+        )
+    )
+    existing = {cc["name"] for cc in inspect(connection).get_columns("_table_status")}
+    for column in ["row_count", "source_total"]:
+        if column not in existing:
+            connection.execute(
+                text(f"ALTER TABLE _table_status ADD COLUMN {column} INTEGER;")
+            )
+    connection.execute(
+        text(
+            "CREATE UNIQUE INDEX IF NOT EXISTS ux__table_status "
+            "ON _table_status (database, table_name);"
+        )
+    )
+    connection.execute(
+        text(
+            "CREATE TABLE IF NOT EXISTS _road_id_status (database TEXT, "
+            "table_name TEXT, road_id INTEGER, row_count INTEGER, content_hash TEXT, "
+            "date_retrieved DATE, PRIMARY KEY (database, table_name, road_id));"
+        )
     )
 
 
 def read_table_status_from_sqlite(
     path=DEFAULT_SQLITE_PATH,
 ):
-    return from_sqlite(
+    table_status = from_sqlite(
         "_table_status",
         path=path,
         date_columns=["date_retrieved"],
         index_columns=["database", "table_name"],
     )
+    if table_status is not None:
+        table_status["full_retrieval"] = table_status["full_retrieval"].astype(bool)
+    return table_status
 
 
 def update_table_status_in_sqlite(
@@ -60,17 +483,135 @@ def update_table_status_in_sqlite(
     table_name,
     entire_table,
     path=DEFAULT_SQLITE_PATH,
+    source_total=None,
+):
+    """
+    Record the retrieval of a table. The local row count is taken from the table,
+    source_total is the number of rows in the RAMM table at the time of retrieval.
+
+    """
+    with get_engine(path).begin() as connection:
+        _create_status_tables(connection)
+        row_count = None
+        if inspect(connection).has_table(table_name):
+            row_count = connection.execute(
+                text(f"SELECT COUNT(*) FROM {_quote(table_name)};")
+            ).scalar()
+        connection.execute(
+            text(
+                "INSERT INTO _table_status (database, table_name, full_retrieval, "
+                "date_retrieved, row_count, source_total) VALUES (:database, "
+                ":table_name, :full_retrieval, :date_retrieved, :row_count, "
+                ":source_total) ON CONFLICT (database, table_name) DO UPDATE SET "
+                "full_retrieval = excluded.full_retrieval, "
+                "date_retrieved = excluded.date_retrieved, "
+                "row_count = excluded.row_count, "
+                "source_total = excluded.source_total;"
+            ),
+            {
+                "database": database,
+                "table_name": table_name,
+                "full_retrieval": bool(entire_table),
+                "date_retrieved": date.today().isoformat(),
+                "row_count": row_count,
+                "source_total": source_total,
+            },
+        )
+
+
+def read_road_id_status_from_sqlite(
+    database,
+    table_name,
+    path=DEFAULT_SQLITE_PATH,
+):
+    """
+    Return the row count, content hash and retrieval date for each road_id of a
+    table (indexed by road_id), or None if no road_id status has been recorded.
+
+    """
+    with get_engine(path).connect() as connection:
+        if not inspect(connection).has_table("_road_id_status"):
+            return None
+        df = pd.read_sql(
+            text(
+                "SELECT road_id, row_count, content_hash, date_retrieved "
+                "FROM _road_id_status "
+                "WHERE database = :database AND table_name = :table_name;"
+            ),
+            connection,
+            params={"database": database, "table_name": table_name},
+        )
+    df["date_retrieved"] = pd.to_datetime(df["date_retrieved"]).dt.date
+    return df.set_index("road_id")
+
+
+def update_road_id_status_in_sqlite(
+    database,
+    table_name,
+    records,
+    path=DEFAULT_SQLITE_PATH,
+    replace_all=False,
+):
+    """
+    Upsert the status of individual road_ids. records is a list of dicts with
+    road_id, row_count and content_hash keys. If replace_all is True the existing
+    road_id status for the table is removed first.
+
+    """
+    with get_engine(path).begin() as connection:
+        _create_status_tables(connection)
+        params = {"database": database, "table_name": table_name}
+        if replace_all:
+            connection.execute(
+                text(
+                    "DELETE FROM _road_id_status "
+                    "WHERE database = :database AND table_name = :table_name;"
+                ),
+                params,
+            )
+        if len(records) == 0:
+            return
+        connection.execute(
+            text(
+                "INSERT INTO _road_id_status (database, table_name, road_id, "
+                "row_count, content_hash, date_retrieved) VALUES (:database, "
+                ":table_name, :road_id, :row_count, :content_hash, :date_retrieved) "
+                "ON CONFLICT (database, table_name, road_id) DO UPDATE SET "
+                "row_count = excluded.row_count, "
+                "content_hash = excluded.content_hash, "
+                "date_retrieved = excluded.date_retrieved;"
+            ),
+            [
+                {
+                    **params,
+                    "road_id": int(rr["road_id"]),
+                    "row_count": int(rr["row_count"]),
+                    "content_hash": rr["content_hash"],
+                    "date_retrieved": date.today().isoformat(),
+                }
+                for rr in records
+            ],
+        )
+
+
+def delete_road_id_status_from_sqlite(
+    database,
+    table_name,
+    road_ids,
+    path=DEFAULT_SQLITE_PATH,
 ):
-    # Read the table status from the SQLite database or create a new one if it
-    # doesn't exist:
-    table_status = read_table_status_from_sqlite(path)
-    if table_status is None:
-        table_status = pd.DataFrame(
-            columns=["database", "table_name", "full_retrieval", "date_retrieved"]
-        ).set_index(["database", "table_name"])
-
-    table_status.loc[(database, table_name), "full_retrieval"] = entire_table
-    table_status.loc[(database, table_name), "date_retrieved"] = date.today()
-
-    engine = create_engine(f"sqlite:///{path.absolute()}")
-    table_status.to_sql("_table_status", engine, if_exists="replace", index=True)
+    """Remove the status of the given road_ids of a table."""
+    with get_engine(path).begin() as connection:
+        if not inspect(connection).has_table("_road_id_status"):
+            return
+        connection.execute(
+            text(
+                "DELETE FROM _road_id_status WHERE database = :database "
+                "AND table_name = :table_name AND road_id IN :road_ids;"
+            ).bindparams(bindparam("road_ids", expanding=True)),
+            {
+                "database": database,
+                "table_name": table_name,
+                "road_ids": [int(rr) for rr in road_ids],
+            },
+        )
@@ -1,13 +1,18 @@
+import os
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from io import UnsupportedOperation
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from threading import Lock
 import pyproj
 import pandas as pd
 import numpy as np
+import shapely
 
 from functools import lru_cache
 from numpy.linalg import norm
 from scipy.spatial import KDTree
-from shapely import ops
-from shapely import shortest_line as shortest_line_
 from shapely.wkt import loads  # Load into geometry namespace
 from shapely.geometry import (
     Point,
@@ -36,17 +41,17 @@ ROADNAME_COLUMNS = [
 ]
 
 
-@lru_cache(maxsize=5)
+# Number of coordinates passed to pyproj in each call when reprojecting in bulk:
+CHUNK_SIZE = 1_000_000
+
+
+@lru_cache(maxsize=64)
 def project(from_crs, to_crs):
     return pyproj.Transformer.from_crs(
         pyproj.CRS(f"epsg:{from_crs:d}"), pyproj.CRS(f"epsg:{to_crs:d}"), always_xy=True
     ).transform
 
 
-def _transform_single(geometry, from_crs=4326, to_crs=2193):
-    return ops.transform(project(from_crs, to_crs), geometry)
-
-
 def transform(geometry, from_crs=4326, to_crs=2193):
     if isinstance(geometry, list):
         if isinstance(geometry[0], Polygon):
@@ -55,49 +60,499 @@ def transform(geometry, from_crs=4326, to_crs=2193):
             geometry = MultiLineString(geometry)
         else:
             geometry = MultiPoint(geometry)
-    return _transform_single(geometry, from_crs, to_crs)
+    return transform_array([geometry], from_crs, to_crs)[0]
+
+
+def transform_coords(x, y, from_crs=4326, to_crs=2193, chunk_size=CHUNK_SIZE):
+    """
+    Reproject arrays of x and y coordinates. The coordinates are copied to
+    contiguous float64 arrays which are reprojected in place, chunk_size
+    coordinates per pyproj call. Missing (NaN) coordinates remain missing.
+
+    """
+    x = np.array(x, dtype="float64")
+    y = np.array(y, dtype="float64")
+    if from_crs == to_crs:
+        return x, y
+    transformer = project(from_crs, to_crs)
+    for start in range(0, len(x), chunk_size):
+        chunk = slice(start, start + chunk_size)
+        transformer(x[chunk], y[chunk], inplace=True)
+    return x, y
+
+
+def transform_array(geometry, from_crs=4326, to_crs=2193, chunk_size=CHUNK_SIZE):
+    """
+    Reproject an array of shapely geometries (or a GeoSeries) in bulk. The
+    coordinates of all the geometries are reprojected together (see
+    transform_coords) and the geometry types and missing values are preserved.
+
+    A Series is returned for a Series (or GeoSeries) with the same index. The crs
+    of a GeoSeries is used where available, and is set to to_crs in the result.
+
+    """
+    if isinstance(geometry, pd.Series):
+        crs = getattr(geometry, "crs", None)
+        if crs is not None:
+            from_crs = crs.to_epsg()
+        kwargs = {} if crs is None else {"crs": f"epsg:{to_crs:d}"}
+        return type(geometry)(
+            transform_array(
+                geometry.to_numpy(dtype=object), from_crs, to_crs, chunk_size
+            ),
+            index=geometry.index,
+            name=geometry.name,
+            **kwargs,
+        )
+
+    geometry = np.asarray(geometry, dtype=object)
+    if from_crs == to_crs:
+        return geometry
+
+    def _transform(coords):
+        x, y = transform_coords(
+            coords[:, 0], coords[:, 1], from_crs, to_crs, chunk_size
+        )
+        return np.column_stack([x, y])
+
+    return shapely.transform(geometry, _transform)
+
+
+def loads_array(wkt, from_crs=4326, to_crs=2193):
+    """
+    Parse an array of WKT strings and reproject the geometries in bulk (equivalent
+    to [transform(loads(ww)) for ww in wkt]). Missing values (None, NaN or empty
+    strings) result in None.
+
+    """
+    wkt = pd.Series(wkt, dtype=object).reset_index(drop=True)
+    wkt = wkt.where(wkt.notnull() & (wkt != ""), None).to_numpy()
+    return transform_array(shapely.from_wkt(wkt), from_crs, to_crs)
 
 
 def _build_point_layer(df, dx: float = 2):
-    geometry, idx, road_id = [], [], []
-    for _, row in df.iterrows():
-        x_start = dx
-        x_end = np.floor(row.geometry.length / dx) * dx
-        if x_end == row.geometry.length:
-            x_end -= dx
-
-        coords = [
-            row.geometry.interpolate(xx, normalized=False)
-            for xx in np.arange(x_start, x_end + dx, dx)
-        ]
+    """
+    Sample points every dx metres along each feature (excluding the start and end
+    of the feature). Returns the coordinates of the points (n x 2 float64 array)
+    along with the position (in df) of the feature of each point.
 
-        # Extract the points and id for each feature:
-        geometry += [Point(xy) for xy in coords]
-        idx += [row.name] * len(coords)
-        road_id += [row.road_id] * len(coords)
+    """
+    geometry = df["geometry"].to_numpy()
+    feature_ii = np.flatnonzero(np.isin(shapely.get_type_id(geometry), [1, 2, 5]))
+
+    # Coordinates of each part of the features, the distance along the features
+    # is accumulated across all the features (gaps between parts aren't counted):
+    parts, part_feature = shapely.get_parts(geometry[feature_ii], return_index=True)
+    coords, coord_part = shapely.get_coordinates(parts, return_index=True)
+    coord_feature = part_feature[coord_part]
+    segment_m = np.hypot(*np.diff(coords, axis=0).T)
+    segment_m[np.diff(coord_part) != 0] = 0
+    distance = np.concatenate([[0], np.cumsum(segment_m)])
+
+    # Distance to the start of each feature and the feature lengths:
+    n_features = len(feature_ii)
+    first = np.searchsorted(coord_feature, np.arange(n_features))
+    last = np.searchsorted(coord_feature, np.arange(n_features), side="right") - 1
+    has_coords = last >= first
+    start = np.where(has_coords, distance[np.minimum(first, len(distance) - 1)], 0)
+    length = np.where(has_coords, distance[np.maximum(last, 0)] - start, 0)
+
+    # Sample at dx, 2dx, ... up to the last multiple of dx before the end:
+    x_end = np.floor(length / dx) * dx
+    x_end[x_end == length] -= dx
+    counts = np.maximum(np.round(x_end / dx), 0).astype(int)
+    sample_feature = np.repeat(np.arange(n_features), counts)
+    offsets = np.cumsum(counts) - counts
+    sample_m = dx * (np.arange(counts.sum()) - np.repeat(offsets, counts) + 1)
+
+    # Interpolate along the segment containing each sample:
+    position = start[sample_feature] + sample_m
+    ii = np.clip(np.searchsorted(distance, position, side="right") - 1, 0, None)
+    ii = np.minimum(ii, len(coords) - 2)
+    fraction = (position - distance[ii]) / (distance[ii + 1] - distance[ii])
+    points = coords[ii] + fraction[:, None] * (coords[ii + 1] - coords[ii])
+
+    return points, feature_ii[sample_feature]
+
+
+def _build_kdtree(points):
+    return KDTree(points)
+
+
+def _point_coords(x, y=None, point_crs=4326):
+    """
+    Return the x and y coordinate arrays (and the crs) of points given as
+    coordinate arrays, or as a GeoSeries or array of shapely points (x, with y
+    None). The crs of a GeoSeries takes precedence over point_crs.
 
-    # Store individual points with corresponding id in a GeoDataFrame:
-    return pd.DataFrame({"id": idx, "road_id": road_id, "geometry": geometry})
+    """
+    if y is None:
+        crs = getattr(x, "crs", None)
+        if crs is not None and crs.to_epsg() is not None:
+            point_crs = crs.to_epsg()
+        geometry = np.asarray(x, dtype=object)
+        return shapely.get_x(geometry), shapely.get_y(geometry), point_crs
+    x = np.asarray(x, dtype="float64")
+    y = np.asarray(y, dtype="float64")
+    return x, y, point_crs
+
+
+class IndexCache:
+    """
+    Least recently used cache of spatial indexes, limited by the (approximate)
+    memory used by the indexes. The most recently used index is always kept,
+    even if it is larger than the limit.
 
+    The cached indexes aren't pickled, they are rebuilt on first use.
 
-def _coords(df):
-    return [gg.coords[0] for gg in df.geometry.tolist()]
+    """
 
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
 
-def _x_coords(coords):
-    return [cc[0] for cc in coords]
+    def __reduce__(self):
+        return IndexCache, (self.max_bytes,)
 
+    def __len__(self):
+        return len(self._entries)
 
-def _y_coords(coords):
-    return [cc[1] for cc in coords]
+    def __contains__(self, key):
+        return key in self._entries
 
+    def get(self, key, build):
+        """
+        Return the cached index for key, calling build() to create the index if it
+        isn't cached. build() must return the index and its size in bytes.
 
-def _build_kdtree(df):
-    return KDTree(np.array(list(zip(_x_coords(_coords(df)), _y_coords(_coords(df))))))
+        """
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                self._evict()
+                return self._entries[key][0]
+            self.misses += 1
+
+        index, nbytes = build()
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = (index, nbytes)
+                self.nbytes += nbytes
+            self._evict()
+        return index
+
+    def _evict(self):
+        while self.nbytes > self.max_bytes and len(self._entries) > 1:
+            _, (_, nbytes) = self._entries.popitem(last=False)
+            self.nbytes -= nbytes
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+
+# Approximate memory used by an STRtree (tree nodes and envelopes) for each
+# geometry, the geometries themselves are shared with the Centreline features:
+STRTREE_BYTES_PER_GEOMETRY = 80
+
+
+def _kdtree_nbytes(points):
+    # scipy keeps a copy of the data along with an index array and the tree nodes
+    # (with the default 16 points per leaf):
+    return 2 * points.nbytes + 8 * len(points) + 100 * (len(points) // 16 + 1)
+
+
+def _pairs(a, b):
+    # Complex numbers are ordered lexicographically by numpy (real then imaginary
+    # part), which allows sorted arrays of pairs to be searched:
+    pairs = np.empty(np.broadcast(a, b).shape, dtype="complex128")
+    pairs.real = a
+    pairs.imag = b
+    return pairs
+
+
+class LinearIndex:
+    """
+    Linear referencing index of the centreline features. The features are sorted
+    by road_id and start position, and the position of each vertex along its
+    feature is stored (as a proportion of the feature length) so that the
+    geometry of road sections can be extracted using binary searches.
 
+    """
 
-class Centreline(object):
     def __init__(self, df: pd.DataFrame):
+        road_id = df["road_id"].to_numpy(dtype="float64", na_value=np.nan)
+        start_m = df["carrway_start_m"].to_numpy(dtype="float64", na_value=np.nan)
+        end_m = df["carrway_end_m"].to_numpy(dtype="float64", na_value=np.nan)
+        self.order = np.lexsort((start_m, road_id))
+        order = self.order
+
+        # Features with missing values are sorted last and never selected:
+        self.road_id = np.nan_to_num(road_id[order], nan=np.inf)
+        self.start_m = np.nan_to_num(start_m[order], nan=np.inf)
+        self.end_m = np.nan_to_num(end_m[order], nan=-np.inf)
+        self.length_m = df["length_m"].to_numpy(dtype="float64", na_value=np.nan)[order]
+        self.geometry = df["geometry"].to_numpy()[order]
+        self._start_key = _pairs(self.road_id, self.start_m)
+        # Running maximum of the end positions of each road (in start order):
+        max_end_m = pd.Series(self.end_m).groupby(self.road_id).cummax()
+        self._max_end_key = _pairs(self.road_id, max_end_m.to_numpy())
+
+        # Vertex positions along each feature:
+        coords, feature = shapely.get_coordinates(self.geometry, return_index=True)
+        self.coords = coords
+        self.n_vertices = np.bincount(feature, minlength=len(order))
+        self.offsets = np.concatenate([[0], np.cumsum(self.n_vertices)])
+        segment_m = np.hypot(*np.diff(coords, axis=0).T)
+        segment_m[np.diff(feature) != 0] = 0
+        distance = np.concatenate([[0], np.cumsum(segment_m)])
+        distance -= distance[self.offsets[feature]]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            position = distance / distance[self.offsets[1:] - 1][feature]
+        self._vertex_key = _pairs(feature, np.nan_to_num(position, nan=-np.inf))
+
+    # Arrays saved by Centreline.save (everything except the geometry):
+    ARRAYS = [
+        "order",
+        "road_id",
+        "start_m",
+        "end_m",
+        "length_m",
+        "coords",
+        "n_vertices",
+        "offsets",
+        "_start_key",
+        "_max_end_key",
+        "_vertex_key",
+    ]
+
+    @classmethod
+    def from_arrays(cls, arrays: dict, geometry: np.ndarray) -> "LinearIndex":
+        """Create the index from saved arrays and the features geometry."""
+        index = cls.__new__(cls)
+        for name in cls.ARRAYS:
+            setattr(index, name, arrays[name])
+        index.geometry = geometry[index.order]
+        return index
+
+    def _vertex_index(self, feature, ref_pos):
+        # Index of the first vertex beyond ref_pos (or the last vertex if there
+        # isn't one):
+        ref_pos = np.nan_to_num(ref_pos, nan=np.inf)
+        ii = np.searchsorted(self._vertex_key, _pairs(feature, ref_pos), side="right")
+        ii -= self.offsets[feature]
+        return np.minimum(ii, self.n_vertices[feature] - 1)
+
+    def extract(self, road_id, start_m, end_m, ends_only: bool = False) -> np.ndarray:
+        """
+        Extract the part of the centreline that corresponds to each section
+        (road_id, start_m, end_m). Returns an array of LineStrings (None where
+        there are no features for a section).
+
+        """
+        road_id = np.asarray(road_id, dtype="float64")
+        start_m = np.asarray(start_m, dtype="float64")
+        end_m = np.asarray(end_m, dtype="float64")
+        n_rows = len(road_id)
+        result = np.full(n_rows, None, dtype=object)
+
+        valid = ~(np.isnan(road_id) | np.isnan(start_m) | np.isnan(end_m))
+        road_id = np.where(valid, road_id, -np.inf)
+        start_m = np.where(valid, start_m, 0)
+        end_m = np.where(valid, end_m, 0)
+
+        # Candidate features start before end_m, from the first feature ending
+        # after start_m:
+        first = np.searchsorted(self._max_end_key, _pairs(road_id, start_m), "right")
+        stop = np.searchsorted(self._start_key, _pairs(road_id, end_m), "left")
+        counts = np.maximum(stop - first, 0)
+        row = np.repeat(np.arange(n_rows), counts)
+        offsets = np.cumsum(counts) - counts
+        feature = np.repeat(first, counts) + np.arange(counts.sum())
+        feature -= np.repeat(offsets, counts)
+        selected = (self.end_m[feature] > start_m[row]) & (
+            self.start_m[feature] < end_m[row]
+        )
+        row, feature = row[selected], feature[selected]
+
+        n_selected = np.bincount(row, minlength=n_rows)
+        found = np.flatnonzero(n_selected)
+        if len(found) == 0:
+            return result
+        n_features = n_selected[found]
+        row_first = np.searchsorted(row, found)
+        first_feature = feature[row_first]
+        last_feature = feature[row_first + n_features - 1]
+        single = n_features == 1
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            start_pos = (start_m[found] - self.start_m[first_feature]) / self.length_m[
+                first_feature
+            ]
+            end_pos = (end_m[found] - self.start_m[last_feature]) / self.length_m[
+                last_feature
+            ]
+        start_points = shapely.line_interpolate_point(
+            self.geometry[first_feature], start_pos, normalized=True
+        )
+        end_points = shapely.line_interpolate_point(
+            self.geometry[last_feature], end_pos, normalized=True
+        )
+        start_xy = np.column_stack(
+            [shapely.get_x(start_points), shapely.get_y(start_points)]
+        )
+        end_xy = np.column_stack([shapely.get_x(end_points), shapely.get_y(end_points)])
+        if ends_only:
+            result[found] = shapely.linestrings(np.stack([start_xy, end_xy], axis=1))
+            return result
+
+        # Each line is built from ranges of vertices (the interpolated start and
+        # end points are appended to the vertices), ordered by rank:
+        n_found = len(found)
+        n_vertices = len(self.coords)
+        coords = np.concatenate([self.coords, start_xy, end_xy])
+        line = np.arange(n_found)
+        ii = self.offsets[first_feature] + self._vertex_index(first_feature, start_pos)
+        jj = self.offsets[last_feature] + self._vertex_index(last_feature, end_pos)
+
+        # Intermediate features (excluding the first vertex, shared with the
+        # previous feature):
+        line_of_row = np.cumsum(n_selected > 0) - 1
+        rank = np.arange(len(row)) - np.repeat(row_first, n_features)
+        middle = (rank > 0) & (rank < n_selected[row] - 1)
+        middle_feature = feature[middle]
+
+        multi = ~single
+        ranges = [
+            # (line, rank, first vertex, stop vertex):
+            (line, 0, n_vertices + line, n_vertices + line + 1),
+            (line[single], 1, ii[single], jj[single]),
+            (line[multi], 1, ii[multi], self.offsets[first_feature[multi] + 1]),
+            (
+                line_of_row[row[middle]],
+                1 + rank[middle],
+                self.offsets[middle_feature] + 1,
+                self.offsets[middle_feature + 1],
+            ),
+            (
+                line[multi],
+                n_features[multi],
+                self.offsets[last_feature[multi]] + 1,
+                jj[multi],
+            ),
+            (
+                line,
+                n_features + 1,
+                n_vertices + n_found + line,
+                n_vertices + n_found + line + 1,
+            ),
+        ]
+        range_line, range_rank, range_start, range_stop = (
+            np.concatenate([np.broadcast_to(rr[kk], rr[0].shape) for rr in ranges])
+            for kk in range(4)
+        )
+        order = np.lexsort((range_rank, range_line))
+        range_line = range_line[order]
+        range_start = range_start[order]
+        range_count = np.maximum(range_stop[order] - range_start, 0)
+
+        offsets = np.cumsum(range_count) - range_count
+        vertex = np.repeat(range_start, range_count) + np.arange(range_count.sum())
+        vertex -= np.repeat(offsets, range_count)
+        result[found] = shapely.linestrings(
+            coords[vertex], indices=np.repeat(range_line, range_count)
+        )
+        return result
+
+
+def _geometry_to_arrays(geometry):
+    """
+    Split the geometry of the features into flat coordinates, the offsets of the
+    parts in the coordinates and the offsets of the features in the parts. Only
+    LineStrings and MultiLineStrings are split, the other (non-missing) geometries
+    are returned as WKB (by position).
+
+    """
+    candidates = np.flatnonzero(np.isin(shapely.get_type_id(geometry), [1, 5]))
+    parts, part_feature = shapely.get_parts(geometry[candidates], return_index=True)
+    invalid = np.bincount(
+        part_feature,
+        weights=shapely.get_num_coordinates(parts) < 2,
+        minlength=len(candidates),
+    )
+    invalid[np.bincount(part_feature, minlength=len(candidates)) == 0] = 1
+    lineal = np.zeros(len(geometry), dtype=bool)
+    lineal[candidates[invalid == 0]] = True
+
+    parts, part_feature = shapely.get_parts(geometry[lineal], return_index=True)
+    coords, coord_part = shapely.get_coordinates(parts, return_index=True)
+    part_counts = np.bincount(
+        np.flatnonzero(lineal)[part_feature], minlength=len(geometry)
+    )
+    coord_counts = np.bincount(coord_part, minlength=len(parts))
+    other = {
+        int(ii): shapely.to_wkb(geometry[ii])
+        for ii in np.flatnonzero(~lineal & ~shapely.is_missing(geometry))
+    }
+    arrays = {
+        "type_id": shapely.get_type_id(geometry).astype("int8"),
+        "coords": coords,
+        "part_offsets": np.concatenate([[0], np.cumsum(coord_counts)]),
+        "feature_offsets": np.concatenate([[0], np.cumsum(part_counts)]),
+    }
+    return arrays, other
+
+
+def _geometry_from_arrays(arrays, other):
+    type_id = arrays["type_id"]
+    part_counts = np.diff(arrays["feature_offsets"])
+    coord_counts = np.diff(arrays["part_offsets"])
+    geometry = np.full(len(type_id), None, dtype=object)
+
+    if len(coord_counts):
+        parts = shapely.linestrings(
+            arrays["coords"],
+            indices=np.repeat(np.arange(len(coord_counts)), coord_counts),
+        )
+        lines = np.flatnonzero((type_id == 1) & (part_counts > 0))
+        geometry[lines] = parts[arrays["feature_offsets"][lines]]
+
+        multi = (type_id == 5) & (part_counts > 0)
+        if multi.any():
+            part_feature = np.repeat(np.arange(len(type_id)), part_counts)
+            in_multi = multi[part_feature]
+            multi_ii = np.flatnonzero(multi)
+            geometry[multi_ii] = shapely.multilinestrings(
+                parts[in_multi],
+                indices=np.searchsorted(multi_ii, part_feature[in_multi]),
+            )
+
+    for position, wkb in other.items():
+        geometry[position] = shapely.from_wkb(wkb)
+    return geometry
+
+
+class Centreline(object):
+    # Spatial indexes, built on first use (class attributes so that Centreline
+    # objects pickled before the indexes were added can still be used):
+    _tree = None
+    _all_tree = None
+    _points = None
+    _point_features = None
+    _kdtree = None
+    _index_cache = None
+    _linear_index = None
+
+    # Memory limit for the cached per-road_id indexes:
+    index_cache_bytes = 256 * 2**20
+
+    def __init__(self, df: pd.DataFrame, index_cache_bytes: Optional[int] = None):
         """
         Used to find the displacement value of a point projected onto the
         nearest road feature. The length of the target line is specified and
@@ -110,26 +565,437 @@ class Centreline(object):
 
         The reference crs is used when projecting the point onto a line.
 
+        The spatial indexes used when the search is limited to a road_id are
+        built on first use and kept in an LRU cache limited to index_cache_bytes
+        (256 MB by default).
+
         """
         self.ref_crs = 2193
+        if index_cache_bytes is not None:
+            self.index_cache_bytes = index_cache_bytes
         self._df_features = df.drop_duplicates(
             ["road_id", "carrway_start_m", "carrway_end_m"]
         )
-        self._df_points = None
+        self._points = None
         self._kdtree = None
 
-        # Only use rows with LineString geometry:
-        is_linestring = self._df_features["geometry"].apply(
-            lambda x: isinstance(x, LineString)
+    def save(self, path, include_points: bool = True):
+        """
+        Save the centreline to a directory. The feature attributes are pickled and
+        the geometry (as flat coordinate arrays), the linear referencing index and
+        the densified points used by the kdtree method (unless include_points is
+        False) are saved as .npy files, so they can be memory mapped by
+        Centreline.load().
+
+        """
+        path = Path(path).expanduser()
+        path.mkdir(parents=True, exist_ok=True)
+        geometry = self._df_features["geometry"].to_numpy()
+        if include_points and self._points is None:
+            self._points, self._point_features = _build_point_layer(self._df_features)
+
+        geometry_arrays, other = _geometry_to_arrays(geometry)
+        arrays = {f"geometry.{kk}": vv for kk, vv in geometry_arrays.items()}
+        arrays.update(
+            {
+                f"linear_index.{kk}": getattr(self.linear_index, kk)
+                for kk in LinearIndex.ARRAYS
+            }
+        )
+        if include_points:
+            arrays["points"] = self._points
+            arrays["point_features"] = self._point_features
+        for name, values in arrays.items():
+            np.save(path / f"{name}.npy", np.asarray(values), allow_pickle=False)
+        # Remove arrays left by a previous save (e.g. the points, when saving
+        # with include_points=False):
+        for ff in path.glob("*.npy"):
+            if ff.name[: -len(".npy")] not in arrays:
+                ff.unlink()
+
+        pd.to_pickle(
+            {
+                "arrays": list(arrays),
+                "attributes": self._df_features.drop(columns="geometry"),
+                "other_geometry": other,
+                "ref_crs": self.ref_crs,
+                "index_cache_bytes": self.index_cache_bytes,
+            },
+            path / "centreline.pkl",
+        )
+
+    @classmethod
+    def load(cls, path, mmap: bool = True) -> "Centreline":
+        """
+        Load a centreline saved using Centreline.save(). With mmap=True the arrays
+        are memory mapped (read only), so the pages are shared between processes
+        through the OS cache. The spatial indexes (STRtrees and KD-trees) are
+        rebuilt from the arrays on first use.
+
+        """
+        path = Path(path).expanduser()
+        saved = pd.read_pickle(path / "centreline.pkl")
+        arrays = {
+            name: np.load(
+                path / f"{name}.npy",
+                mmap_mode="r" if mmap else None,
+                allow_pickle=False,
+            )
+            for name in saved["arrays"]
+        }
+
+        def _arrays(prefix):
+            return {
+                kk[len(prefix) + 1 :]: vv
+                for kk, vv in arrays.items()
+                if kk.startswith(f"{prefix}.")
+            }
+
+        geometry = _geometry_from_arrays(_arrays("geometry"), saved["other_geometry"])
+        df = saved["attributes"]
+        df["geometry"] = geometry
+
+        # The features were deduplicated when the centreline was created:
+        centreline = cls.__new__(cls)
+        centreline.ref_crs = saved["ref_crs"]
+        centreline.index_cache_bytes = saved["index_cache_bytes"]
+        centreline._df_features = df
+        centreline._linear_index = LinearIndex.from_arrays(
+            _arrays("linear_index"), geometry
+        )
+        centreline._points = arrays.get("points")
+        centreline._point_features = arrays.get("point_features")
+        return centreline
+
+    @property
+    def index_cache(self) -> IndexCache:
+        """Cache of the per-road_id spatial indexes."""
+        if self._index_cache is None:
+            self._index_cache = IndexCache(self.index_cache_bytes)
+        return self._index_cache
+
+    @property
+    def linear_index(self) -> LinearIndex:
+        """Linear referencing index of the features, built on first use."""
+        if self._linear_index is None:
+            self._linear_index = LinearIndex(self._df_features)
+        return self._linear_index
+
+    def _feature_tree(self, road_id=None):
+        """
+        Return an STRtree of the LineString features (or of the features of a
+        single road_id) and the positions of the tree geometries in _df_features.
+        The trees are built on first use, the per-road_id trees are kept in the
+        index cache.
+
+        """
+        if road_id is None:
+            if self._tree is None:
+                self._tree = self._build_feature_tree()[0]
+            return self._tree
+        return self.index_cache.get(
+            ("strtree", road_id), lambda: self._build_feature_tree(road_id)
+        )
+
+    def _geometry_tree(self):
+        """Return an STRtree of all the features (built on first use)."""
+        if self._all_tree is None:
+            self._all_tree = shapely.STRtree(self._df_features["geometry"].to_numpy())
+        return self._all_tree
+
+    def _build_feature_tree(self, road_id=None):
+        geometry = self._df_features["geometry"].to_numpy()
+        mask = np.isin(shapely.get_type_id(geometry), [1, 2])  # LineStrings
+        if road_id is not None:
+            mask &= (self._df_features["road_id"] == road_id).to_numpy()
+        positions = np.flatnonzero(mask)
+        nbytes = positions.nbytes + STRTREE_BYTES_PER_GEOMETRY * len(positions)
+        return (shapely.STRtree(geometry[positions]), positions), nbytes
+
+    def _road_kdtree(self, road_id):
+        """
+        Return a KD-tree of the densified points of a road_id along with the
+        point coordinates and feature positions (kept in the index cache).
+
+        """
+
+        def build():
+            road_ids = self._df_features["road_id"].to_numpy()
+            selected = road_ids[self._point_features] == road_id
+            points = self._points[selected]
+            features = self._point_features[selected]
+            return (_build_kdtree(points), points, features), _kdtree_nbytes(points)
+
+        return self.index_cache.get(("kdtree", road_id), build)
+
+    def _nearest_features(self, points, road_id=None):
+        """
+        Return the positions (in _df_features) of the features nearest to an array
+        of points along with the distances. Where several features are equally
+        near (within 1 mm of the nearest location on the network) the first
+        feature in _df_features order is used. Points without a feature (e.g.
+        empty points) have position -1 and distance NaN.
+
+        """
+        tree, positions = self._feature_tree(road_id)
+        feature = np.full(len(points), -1)
+        distance = np.full(len(points), np.nan)
+        if len(positions) == 0:
+            return feature, distance
+
+        (point_ii, tree_ii), distances = tree.query_nearest(
+            points, return_distance=True
+        )
+        _, first = np.unique(point_ii, return_index=True)
+        point_ii, tree_ii, distances = point_ii[first], tree_ii[first], distances[first]
+
+        # Features touching the nearest location on the network (e.g. the adjacent
+        # feature at a shared vertex) are equally near, use the first feature in
+        # _df_features order (the tree geometries are in the same order):
+        nearest = shapely.get_point(
+            shapely.shortest_line(tree.geometries[tree_ii], points[point_ii]), 0
+        )
+        candidate_ii, candidate_tree_ii = tree.query(
+            nearest, predicate="dwithin", distance=0.001
+        )
+        best = np.full(len(point_ii), len(positions))
+        np.minimum.at(best, candidate_ii, candidate_tree_ii)
+
+        feature[point_ii] = positions[best]
+        distance[point_ii] = distances
+        return feature, distance
+
+    def position_many(
+        self,
+        x,
+        y=None,
+        point_crs: int = 4326,
+        road_id: Optional[Union[int, np.ndarray]] = None,
+        workers: Optional[int] = None,
+    ) -> pd.DataFrame:
+        """
+        Find the position along the nearest line for many points at once (the
+        equivalent of calling position() for each point).
+
+        :param x: x coordinates (e.g. longitude), or a GeoSeries / array of shapely
+            points (in which case y is not used)
+        :param y: y coordinates (e.g. latitude)
+        :param point_crs: crs of the points, defaults to 4326 (the crs of a
+            GeoSeries is used where available)
+        :param road_id: limit the search to a road_id, either a single road_id for
+            all the points or an array with a road_id for each point
+        :param workers: number of processes used to match the points, the points
+            are matched in the current process by default
+        :return: DataFrame with `road_id`, `position_m` and `search_offset_m`
+            columns (one row per point, using the index of a GeoSeries)
+
+        """
+        index = x.index if isinstance(x, pd.Series) else None
+        x, y, point_crs = _point_coords(x, y, point_crs)
+        if point_crs != self.ref_crs:
+            x, y = transform_coords(x, y, point_crs, self.ref_crs)
+        if workers is not None and workers > 1:
+            result = self._position_many_parallel(x, y, road_id, workers)
+            if index is not None:
+                result.index = index
+            return result
+        points = shapely.points(x, y)
+
+        if road_id is None or np.ndim(road_id) == 0:
+            feature, offset_m = self._nearest_features(points, road_id)
+        else:
+            road_id = np.asarray(road_id)
+            feature = np.full(len(points), -1)
+            offset_m = np.full(len(points), np.nan)
+            for rr in pd.unique(road_id):
+                ii = np.flatnonzero(road_id == rr)
+                feature[ii], offset_m[ii] = self._nearest_features(points[ii], rr)
+
+        found = feature >= 0
+        features = self._df_features.iloc[feature[found]]
+        position = shapely.line_locate_point(
+            features["geometry"].to_numpy(), points[found], normalized=True
         )
-        self._geometry = MultiLineString(
-            self._df_features.loc[is_linestring, "geometry"].to_list()
+
+        road_ids = np.full(len(points), np.nan)
+        road_ids[found] = features["road_id"].to_numpy(dtype="float64")
+        position_m = np.full(len(points), np.nan)
+        position_m[found] = features["carrway_start_m"].to_numpy(
+            dtype="float64"
+        ) + position * features["length_m"].to_numpy(dtype="float64")
+        return pd.DataFrame(
+            {
+                "road_id": pd.Series(road_ids, index=index).astype("Int64"),
+                "position_m": pd.Series(position_m, index=index),
+                "search_offset_m": pd.Series(offset_m, index=index),
+            }
         )
 
+    def match_trace(
+        self,
+        x,
+        y=None,
+        point_crs: int = 4326,
+        search_radius_m: float = 50,
+        sigma_m: float = 10,
+        beta_m: float = 5,
+        switch_penalty_m: float = 50,
+    ) -> pd.DataFrame:
+        """
+        Find the positions of an ordered trace of points (e.g. a GPS survey),
+        choosing the most likely continuous path rather than the nearest line for
+        each point, so that the matches don't jump between nearby carriageways.
+
+        The candidate features of each point are searched for on the road_id of
+        the previous point's best match first (within search_radius_m). The
+        search is widened to all the features where that road has no candidates
+        within 2 * sigma_m (e.g. the trace has turned onto another road), and to
+        the nearest feature where nothing is within search_radius_m. The cost of
+        a candidate is based on its distance from the point (GPS error with
+        standard deviation sigma_m) and the difference between the change in
+        position along the road and the distance between the points (with scale
+        beta_m). Changing road_id costs switch_penalty_m. The trace is split
+        where points can't be matched (e.g. missing coordinates).
+
+        :param x: x coordinates (e.g. longitude), or a GeoSeries / array of shapely
+            points (in which case y is not used)
+        :param y: y coordinates (e.g. latitude)
+        :param point_crs: crs of the points, defaults to 4326 (the crs of a
+            GeoSeries is used where available)
+        :return: DataFrame with `road_id`, `position_m` and `search_offset_m`
+            columns (one row per point, using the index of a GeoSeries)
+
+        """
+        index = x.index if isinstance(x, pd.Series) else None
+        x, y, point_crs = _point_coords(x, y, point_crs)
+        if point_crs != self.ref_crs:
+            x, y = transform_coords(x, y, point_crs, self.ref_crs)
+        points = shapely.points(x, y)
+        points[np.isnan(x) | np.isnan(y)] = None
+        n_points = len(points)
+        step_m = np.hypot(np.diff(x), np.diff(y))
+
+        geometry = self._df_features["geometry"].to_numpy()
+        road_ids = self._df_features["road_id"].to_numpy(dtype="float64")
+        start_m = self._df_features["carrway_start_m"].to_numpy(dtype="float64")
+        length_m = self._df_features["length_m"].to_numpy(dtype="float64")
+
+        # Find the candidates of each point along with the lowest cost path to each
+        # candidate (Viterbi), previous is None at the start of each continuous
+        # part of the trace:
+        candidates = [None] * n_points
+        previous = None
+        for ii, point in enumerate(points):
+            if point is None:
+                previous = None
+                continue
+            feature, offset_m = self._trace_candidates(
+                point, geometry, previous, search_radius_m, 2 * sigma_m
+            )
+            if len(feature) == 0:
+                previous = None
+                continue
+            position_m = start_m[feature] + (
+                shapely.line_locate_point(geometry[feature], point, normalized=True)
+                * length_m[feature]
+            )
+            cost = 0.5 * (offset_m / sigma_m) ** 2
+            back = np.full(len(feature), -1)
+            if previous is not None:
+                transition_m = np.abs(
+                    np.abs(position_m - previous["position_m"][:, None])
+                    - step_m[ii - 1]
+                )
+                same_road = road_ids[feature] == previous["road_id"][:, None]
+                transition_m = np.where(same_road, transition_m, switch_penalty_m)
+                total = previous["cost"][:, None] + transition_m / beta_m
+                back = np.argmin(total, axis=0)
+                cost = cost + total[back, np.arange(len(feature))]
+            candidates[ii] = previous = {
+                "road_id": road_ids[feature],
+                "position_m": position_m,
+                "search_offset_m": offset_m,
+                "cost": cost,
+                "back": back,
+            }
+
+        # Trace back from the end of each continuous part of the trace:
+        result = {
+            name: np.full(n_points, np.nan)
+            for name in ["road_id", "position_m", "search_offset_m"]
+        }
+        for ii in range(n_points):
+            if candidates[ii] is None or (
+                ii + 1 < n_points and candidates[ii + 1] is not None
+            ):
+                continue
+            jj, candidate = ii, np.argmin(candidates[ii]["cost"])
+            while candidate >= 0:
+                for name, values in result.items():
+                    values[jj] = candidates[jj][name][candidate]
+                jj, candidate = jj - 1, candidates[jj]["back"][candidate]
+
+        result = {
+            name: pd.Series(values, index=index) for name, values in result.items()
+        }
+        result["road_id"] = result["road_id"].astype("Int64")
+        return pd.DataFrame(result)
+
+    def _trace_candidates(
+        self, point, geometry, previous, search_radius_m, max_offset_m
+    ):
+        # Return the candidate features of a point of a trace and their distances
+        # from the point, searching the road_id of the previous best match first.
+        if previous is not None:
+            road_id = previous["road_id"][np.argmin(previous["cost"])]
+            tree, positions = self._feature_tree(int(road_id))
+            feature = np.sort(
+                positions[
+                    tree.query(point, predicate="dwithin", distance=search_radius_m)
+                ]
+            )
+            offset_m = shapely.distance(geometry[feature], point)
+            if len(feature) and offset_m.min() <= max_offset_m:
+                return feature, offset_m
+
+        tree, positions = self._feature_tree()
+        feature = positions[
+            tree.query(point, predicate="dwithin", distance=search_radius_m)
+        ]
+        if len(feature) == 0 and len(positions):
+            feature = positions[tree.query_nearest(point)]
+        feature = np.sort(feature)
+        return feature, shapely.distance(geometry[feature], point)
+
+    def _position_many_parallel(self, x, y, road_id, workers, batches_per_worker=4):
+        # The centreline is saved once to shared memory (where available) and
+        # memory mapped by each worker process, the points are matched in batches:
+        shared_memory = "/dev/shm" if os.path.isdir("/dev/shm") else None
+        batches = np.array_split(np.arange(len(x)), workers * batches_per_worker)
+        batches = [bb for bb in batches if len(bb)]
+        with TemporaryDirectory(dir=shared_memory) as path:
+            self.save(path, include_points=False)
+            with ProcessPoolExecutor(
+                workers, initializer=_init_worker, initargs=(path,)
+            ) as executor:
+                results = executor.map(
+                    _position_many_worker,
+                    [x[bb] for bb in batches],
+                    [y[bb] for bb in batches],
+                    [
+                        road_id if np.ndim(road_id) == 0 else np.asarray(road_id)[bb]
+                        for bb in batches
+                    ],
+                )
+                results = list(results)
+        if not results:
+            return self.position_many(x, y, self.ref_crs, road_id)
+        return pd.concat(results, ignore_index=True)
+
     def _build_kdtree(self):
-        self._df_points = _build_point_layer(self._df_features)
-        self._kdtree = _build_kdtree(self._df_points)
-        self._geometry = None
+        if self._points is None:
+            self._points, self._point_features = _build_point_layer(self._df_features)
+        self._kdtree = _build_kdtree(self._points)
 
     def build_limited_centreline(
         self,
@@ -140,16 +1006,15 @@ class Centreline(object):
         if point_crs != self.ref_crs:
             points = transform(points, point_crs, self.ref_crs)
 
-        df_features_records = []
-        for carr_way_no, row in self._df_features.iterrows():
-            buffered_line = row.geometry.buffer(buffer_distance_m)
-            if not buffered_line.intersects(points):
-                continue
-            row_dict = row.to_dict()
-            row_dict["carr_way_no"] = carr_way_no
-            df_features_records.append(row_dict)
-
-        return Centreline(pd.DataFrame(df_features_records).set_index("carr_way_no"))
+        # Features within buffer_distance_m of any of the points (in the order of
+        # the features):
+        _, selected = self._geometry_tree().query(
+            shapely.get_parts(points), predicate="dwithin", distance=buffer_distance_m
+        )
+        return Centreline(
+            self._df_features.iloc[np.unique(selected)],
+            index_cache_bytes=self.index_cache_bytes,
+        )
 
     def nearest_feature(
         self,
@@ -183,32 +1048,13 @@ class Centreline(object):
         Find the id of the feature nearest to a specified point.
 
         """
-        selected_geometries = self._geometry
-        if road_id is not None:
-            selected_geometries = MultiLineString(
-                self._df_features.loc[
-                    self._df_features["road_id"] == road_id,
-                    "geometry",
-                ].to_list()
-            )
-
-        shortest_line = shortest_line_(selected_geometries, point)
-        for intersecting_point in [Point(pp) for pp in shortest_line.coords]:
-            if intersecting_point != point.coords[0]:
-                break
-
-        for _, row in self._df_features.iterrows():
-            if row.geometry.distance(intersecting_point) < 0.001:
-                # Skip if the road_ids don't match:
-                if road_id is not None and row.road_id != road_id:
-                    continue
-
-                return (
-                    row.name,  # carr_way_no
-                    shortest_line.length,  # offset_m
-                )
-
-        return None, None
+        feature, offset_m = self._nearest_features(np.array([point]), road_id)
+        if feature[0] < 0:
+            return None, None
+        return (
+            self._df_features.index[feature[0]],  # carr_way_no
+            offset_m[0],
+        )
 
     def nearest_feature_kdtree(
         self,
@@ -220,18 +1066,17 @@ class Centreline(object):
 
         """
         if road_id is None:
-            df_points = self._df_points
+            points, features = self._points, self._point_features
             kdtree = self._kdtree
         else:
-            df_points = self._df_points[self._df_points["road_id"] == road_id]
-            kdtree = _build_kdtree(df_points)
+            kdtree, points, features = self._road_kdtree(road_id)
 
         _, ii = kdtree.query(point.coords[0], 2)
-        carr_way_no = df_points.iloc[ii[0]]["id"]
+        carr_way_no = self._df_features.index[features[ii[0]]]
 
         # Calculate offset distance:
-        p1 = np.array(df_points.iloc[ii[0]]["geometry"].coords)[0]
-        p2 = np.array(df_points.iloc[ii[1]]["geometry"].coords)[0]
+        p1 = points[ii[0]]
+        p2 = points[ii[1]]
         p3 = np.array(point.coords)[0]
 
         offset_m = np.abs(_cross2d(p2 - p1, p1 - p3)) / norm(p2 - p1)
@@ -270,7 +1115,9 @@ class Centreline(object):
         start_m = self._df_features.loc[carr_way_no, "carrway_start_m"]
         length_m = self._df_features.loc[carr_way_no, "length_m"]
 
-        position = self._df_features.geometry[carr_way_no].project(point, True)
+        position = self._df_features.geometry[carr_way_no].project(
+            point, normalized=True
+        )
 
         return {
             "position_m": start_m + position * length_m,
@@ -296,29 +1143,26 @@ class Centreline(object):
         if geometry_type not in ["wkt", "coord"]:
             raise AttributeError
 
-        geometry = []
-        for _, row in df.iterrows():
-            geometry.append(
-                self.extract_geometry(
-                    row["road_id"],
-                    row["start_m"],
-                    row["end_m"],
-                    ends_only,
-                )
-            )
+        geometry = self.linear_index.extract(
+            df["road_id"].to_numpy(dtype="float64", na_value=np.nan),
+            df["start_m"].to_numpy(dtype="float64", na_value=np.nan),
+            df["end_m"].to_numpy(dtype="float64", na_value=np.nan),
+            ends_only,
+        )
         if geometry_type == "wkt":
             df["wkt"] = self._extract_wkt_from_list_of_geometry_objects(geometry)
         elif geometry_type == "coord":
-            coords = [gg.coords[0] for gg in geometry]
-            df["easting"] = [cc[0] for cc in coords]
-            df["northing"] = [cc[1] for cc in coords]
+            start_points = shapely.get_point(geometry, 0)
+            df["easting"] = shapely.get_x(start_points)
+            df["northing"] = shapely.get_y(start_points)
         return df
 
     @staticmethod
     def _extract_wkt_from_list_of_geometry_objects(
         geometry: List[Optional[BaseGeometry]],
     ) -> List[Optional[str]]:
-        return [gg.wkt if gg else None for gg in geometry]
+        geometry = np.asarray(geometry, dtype=object)
+        return shapely.to_wkt(geometry, rounding_precision=-1).tolist()
 
     def extract_geometry(
         self, road_id: int, start_m: float, end_m: float, ends_only: bool = False
@@ -333,86 +1177,22 @@ class Centreline(object):
         :return: linestring geometry of road section
 
         """
-        centreline = self._df_features
-
-        selected_cways = centreline.loc[
-            (centreline["road_id"] == road_id)
-            & (centreline["carrway_end_m"] > start_m)
-            & (centreline["carrway_start_m"] < end_m)
-        ].sort_values("carrway_start_m")
-
-        cway_no = selected_cways.index.tolist()
-        if len(cway_no) == 0:
-            return None
-
-        # Find start:
-        current_cway = centreline.loc[cway_no[0]]
-        ref_pos = (start_m - current_cway["carrway_start_m"]) / current_cway["length_m"]
-        extracted_coords = [
-            current_cway["geometry"].interpolate(ref_pos, normalized=True).coords[0]
-        ]
+        return self.linear_index.extract([road_id], [start_m], [end_m], ends_only)[0]
 
-        for ii, cc in enumerate(current_cway["geometry"].coords):
-            pos = current_cway["geometry"].project(Point(cc), normalized=True)
-            if pos > ref_pos:
-                break
 
-        if len(selected_cways) == 1:
-            # There both start_m and end_m lie on the same carr_way elements.
+# Centreline used by position_many worker processes:
+_worker_centreline = None
 
-            # Find the end point:
-            ref_pos = (end_m - current_cway["carrway_start_m"]) / current_cway[
-                "length_m"
-            ]
-            for jj, cc in enumerate(current_cway["geometry"].coords):
-                pos = current_cway["geometry"].project(Point(cc), normalized=True)
-                if pos > ref_pos:
-                    break
-
-            # Build geometry:
-            extracted_coords += current_cway["geometry"].coords[ii:jj]
-            extracted_coords.append(
-                current_cway["geometry"].interpolate(ref_pos, normalized=True).coords[0]
-            )
 
-        else:
-            # Find the end point.
-            # Select the last carr_way element
-            current_cway = centreline.loc[cway_no[-1]]
-            ref_pos = (end_m - current_cway["carrway_start_m"]) / current_cway[
-                "length_m"
-            ]
-            for jj, cc in enumerate(current_cway["geometry"].coords):
-                pos = current_cway["geometry"].project(Point(cc), normalized=True)
-                if pos > ref_pos:
-                    break
-
-            # Build geometry.
-            # Coords from first carr_way element:
-            extracted_coords += centreline.loc[cway_no[0]]["geometry"].coords[ii:]
-
-            if len(selected_cways) > 2:
-                # There are additional (complete) carr_way elements between the
-                # first and last carr_way elements:
-                for kk in cway_no[1:-1]:
-                    # The first point is shared with the previous carr_way
-                    # element, so don't append it.
-                    extracted_coords += centreline.loc[kk]["geometry"].coords[1:]
-
-            # Add the points from the last carr_way element. Ignore the first
-            # point (shared with previous carr_way element).
-            extracted_coords += centreline.loc[cway_no[-1]]["geometry"].coords[1:jj]
-            # Finally add the last point (interpolated).
-            extracted_coords.append(
-                centreline.loc[cway_no[-1]]["geometry"]
-                .interpolate(ref_pos, normalized=True)
-                .coords[0]
-            )
+def _init_worker(path):
+    global _worker_centreline
+    _worker_centreline = Centreline.load(path)
 
-        if ends_only:
-            return LineString([extracted_coords[0], extracted_coords[-1]])
 
-        return LineString(extracted_coords)
+def _position_many_worker(x, y, road_id):
+    return _worker_centreline.position_many(
+        x, y, point_crs=_worker_centreline.ref_crs, road_id=road_id
+    )
 
 
 def build_chainage_layer(
@@ -446,7 +1226,8 @@ def build_label_layer(
 ):
     df = df.copy()
 
-    # Set ramp direction to increasing:
+    # Set ramp direction to increasing (sh_direction may be categorical):
+    df["sh_direction"] = df["sh_direction"].astype(object)
     df.loc[df["sh_element_type"] == "RMP", "sh_direction"] = "I"
 
     # Copy df for labels:
@@ -485,7 +1266,7 @@ def _build_viewport_base_table(selected, width_m):
         "sh_ramp_no",
     ]
     df = pd.DataFrame()
-    for vv, gg in selected.groupby(groupby, dropna=False):
+    for vv, gg in selected.groupby(groupby, dropna=False, observed=True):
         if vv[groupby.index("sh_element_type")] == "RND":
             continue
 
@@ -711,7 +1492,7 @@ def _build_chainage_base_table(
         "sh_ramp_no",
     ]
     df = pd.DataFrame()
-    for vv, gg in selected.groupby(groupby, dropna=False):
+    for vv, gg in selected.groupby(groupby, dropna=False, observed=True):
         if vv[groupby.index("sh_element_type")] == "RND":
             continue
 
@@ -807,7 +1588,7 @@ def combine_continuous_segments(
     """
     sort_columns = ["road_id", "start_m", "end_m"]
     combined = pd.DataFrame()
-    for values, gg in df.groupby(groupby):
+    for values, gg in df.groupby(groupby, observed=True):
         gg = gg.drop_duplicates(["start_m", "end_m"]).sort_values(["start_m", "end_m"])
         gg.set_index(pd.Index([1] * len(gg)), inplace=True)
 
@@ -48,3 +48,49 @@ def _extract_records_from_grid(grid):
 
 def _cross2d(x, y):
     return x[..., 0] * y[..., 1] - x[..., 1] * y[..., 0]
+
+
+def _arrow_errors():
+    import pyarrow as pa
+
+    return (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError)
+
+
+def _frame_from_rows(rows, columns, dtype_backend=None):
+    # Build a DataFrame from the rows returned by the RAMM API. With the "pyarrow"
+    # dtype backend each column is built directly as an Arrow array, columns with
+    # mixed value types fall back to object dtype.
+    if dtype_backend != "pyarrow":
+        return pd.DataFrame(rows, columns=columns)
+
+    import pyarrow as pa
+
+    data = {}
+    for ii, cc in enumerate(columns):
+        values = [rr[ii] for rr in rows]
+        try:
+            data[cc] = pd.arrays.ArrowExtensionArray(pa.array(values))
+        except _arrow_errors():
+            data[cc] = pd.array(values, dtype=object)
+    return pd.DataFrame(data, columns=columns)
+
+
+def _to_arrow(df):
+    # Convert the columns of a DataFrame to Arrow-backed dtypes. Arrow and
+    # categorical columns are left unchanged, as are columns holding other Python
+    # objects (e.g. shapely geometry).
+    import pyarrow as pa
+
+    df = df.copy(deep=False)
+    for cc in df.columns:
+        series = df[cc]
+        if not isinstance(series, pd.Series) or isinstance(
+            series.dtype, (pd.ArrowDtype, pd.CategoricalDtype)
+        ):
+            continue
+        try:
+            array = pa.array(series, from_pandas=True)
+        except _arrow_errors():
+            continue
+        df[cc] = pd.Series(pd.arrays.ArrowExtensionArray(array), index=df.index)
+    return df
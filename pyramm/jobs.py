@@ -0,0 +1,73 @@
+from dataclasses import dataclass, field
+from threading import Lock
+from time import monotonic, sleep
+from typing import Optional
+
+
+class RateLimiter:
+    """
+    Limits the rate of requests made from any number of threads.
+
+    """
+
+    def __init__(self, requests_per_second: float):
+        self.interval = 1 / requests_per_second
+        self._next_time = monotonic()
+        self._lock = Lock()
+
+    def wait(self):
+        with self._lock:
+            now = monotonic()
+            wait_until = max(self._next_time, now)
+            self._next_time = wait_until + self.interval
+        sleep(wait_until - now)
+
+
+@dataclass
+class PullProgress:
+    """
+    Progress of a pull_many job. A unit is one table (or one road_id of a table).
+
+    """
+
+    units_total: int
+    units_done: int = 0
+    units_failed: int = 0
+    rows: int = 0
+    start_time: float = field(default_factory=monotonic)
+    _lock: Lock = field(default_factory=Lock, repr=False)
+
+    def update(self, rows: Optional[int] = None, failed: bool = False):
+        with self._lock:
+            if failed:
+                self.units_failed += 1
+            else:
+                self.units_done += 1
+                self.rows += rows or 0
+
+    def retry(self):
+        # Failed units are being retried:
+        with self._lock:
+            self.units_failed = 0
+
+    @property
+    def elapsed_s(self) -> float:
+        return monotonic() - self.start_time
+
+    @property
+    def rows_per_s(self) -> float:
+        return self.rows / self.elapsed_s if self.elapsed_s > 0 else 0.0
+
+    @property
+    def eta_s(self) -> Optional[float]:
+        if self.units_done == 0:
+            return None
+        remaining = self.units_total - self.units_done - self.units_failed
+        return remaining * self.elapsed_s / self.units_done
+
+    def __str__(self):
+        eta = "unknown" if self.eta_s is None else f"{self.eta_s:.0f}s"
+        return (
+            f"{self.units_done}/{self.units_total} units ({self.units_failed} failed), "
+            f"{self.rows} rows, {self.rows_per_s:.0f} rows/s, ETA {eta}"
+        )
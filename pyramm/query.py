@@ -0,0 +1,201 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, replace
+from itertools import islice
+from typing import Iterator, Optional
+
+import pandas as pd
+
+from pyramm.tables import hdr_table_name
+
+
+@dataclass(frozen=True)
+class TableQuery:
+    """
+    Lazy query against a RAMM table, created using Connection.table(). The
+    conditions and column selection are recorded and only executed by collect()
+    or iter(), e.g.
+
+        conn.table("hsd_rough").where(road_id=[1715, 1716], latest=True).select(
+            ["road_id", "start_m", "end_m", "lane", "iri"]
+        ).collect()
+
+    The conditions are sent to the RAMM API as filters (or applied by the local
+    store), so only the requested rows are retrieved. Results are returned in the
+    same form as Connection.get_data and use the same file cache.
+
+    """
+
+    conn: object
+    table_name: str
+    road_ids: Optional[tuple] = None
+    latest: bool = False
+    survey_year: Optional[int] = None
+    filters: tuple = ()
+    columns: Optional[tuple] = None
+    get_geometry: bool = False
+
+    def where(
+        self,
+        road_id=None,
+        latest: Optional[bool] = None,
+        survey_year: Optional[int] = None,
+        start_m: Optional[float] = None,
+        end_m: Optional[float] = None,
+        **conditions,
+    ) -> "TableQuery":
+        """
+        Add conditions to the query.
+
+        Parameters
+        ----------
+        road_id : int or list[int], optional
+            Limit the result to one or more road_ids (further calls narrow the
+            selection)
+        latest : bool, optional
+            Only return the latest rows (latest == "L")
+        survey_year : int, optional
+            Limit a high speed data table to the surveys carried out in the year
+            (resolved using the header table)
+        start_m, end_m : float, optional
+            Only return rows that overlap the start_m to end_m range
+        **conditions :
+            column=value (EqualTo) or column=[values] (In) conditions
+
+        """
+        new = self
+        if road_id is not None:
+            road_ids = road_id if isinstance(road_id, (list, tuple)) else [road_id]
+            road_ids = tuple(int(rr) for rr in road_ids)
+            if self.road_ids is not None:
+                road_ids = tuple(rr for rr in self.road_ids if rr in road_ids)
+            new = replace(new, road_ids=road_ids)
+        if latest is not None:
+            new = replace(new, latest=latest)
+        if survey_year is not None:
+            new = replace(new, survey_year=int(survey_year))
+
+        filters = []
+        if start_m is not None:
+            filters.append(_filter("end_m", "GreaterThan", start_m))
+        if end_m is not None:
+            filters.append(_filter("start_m", "LessThan", end_m))
+        for column, value in conditions.items():
+            if isinstance(value, (list, tuple)):
+                filters.append(_filter(column, "In", ",".join(map(str, value))))
+            else:
+                filters.append(_filter(column, "EqualTo", value))
+        return replace(new, filters=new.filters + tuple(filters))
+
+    def select(self, columns: list[str], geometry: bool = False) -> "TableQuery":
+        """Limit the result to the given columns (and the geometry if requested)."""
+        return replace(self, columns=tuple(columns), get_geometry=geometry)
+
+    def with_geometry(self) -> "TableQuery":
+        """Include the geometry in the result."""
+        return replace(self, get_geometry=True)
+
+    def _survey_filter(self):
+        hdr_table = hdr_table_name(self.table_name)
+        if hdr_table is None:
+            raise ValueError(f"'{self.table_name}' doesn't have a survey header table")
+        hdr = self.conn.get_data(hdr_table, columns=["survey_number", "survey_date"])
+        years = pd.to_datetime(hdr["survey_date"]).dt.year
+        survey_numbers = hdr.loc[(years == self.survey_year).astype(bool)]
+        # Match nothing if there were no surveys in the year:
+        value = ",".join(map(str, survey_numbers["survey_number"])) or "-1"
+        return _filter("survey_number", "In", value)
+
+    def _api_filters(self):
+        filters = [dict(ff) for ff in self.filters]
+        if self.survey_year is not None:
+            filters.append(self._survey_filter())
+        if self.road_ids is not None and len(self.road_ids) == 0:
+            # The road_id conditions don't overlap, match nothing:
+            filters.append(_filter("road_id", "In", "-1"))
+        return filters
+
+    def _use_local(self):
+        road_ids = None if self.road_ids is None else list(self.road_ids)
+        return self.conn.offline or self.conn._use_local(self.table_name, road_ids)
+
+    def plan(self) -> dict:
+        """Return a description of how the query will be executed."""
+        return {
+            "table_name": self.table_name,
+            "source": "local" if self._use_local() else "api",
+            "road_ids": None if self.road_ids is None else list(self.road_ids),
+            "latest": self.latest,
+            "survey_year": self.survey_year,
+            "filters": [dict(ff) for ff in self.filters],
+            "columns": None if self.columns is None else list(self.columns),
+            "get_geometry": self.get_geometry,
+        }
+
+    def _get_data(self, road_ids, filters, threads=4):
+        return self.conn.get_data(
+            self.table_name,
+            road_id=road_ids,
+            latest=self.latest,
+            get_geometry=self.get_geometry,
+            threads=threads,
+            filters=filters,
+            columns=None if self.columns is None else list(self.columns),
+        )
+
+    def collect(self, threads: int = 4) -> pd.DataFrame:
+        """Execute the query and return the result as a single DataFrame."""
+        road_ids = None if self.road_ids is None else list(self.road_ids)
+        return self._get_data(road_ids, self._api_filters(), threads)
+
+    def iter(self, threads: int = 4) -> Iterator[pd.DataFrame]:
+        """
+        Execute the query and yield the result in parts: one DataFrame per road_id
+        where road_ids have been selected, otherwise one page of rows at a time
+        (or the entire table when served from the local store). Up to `threads`
+        parts are retrieved in parallel ahead of the consumer.
+
+        """
+        filters = self._api_filters()
+        if self.road_ids:
+            with ThreadPoolExecutor(threads) as executor:
+                road_ids = iter(self.road_ids)
+                pending = deque(
+                    executor.submit(self._get_data, rr, filters, 1)
+                    for rr in islice(road_ids, threads)
+                )
+                while pending:
+                    df = pending.popleft().result()
+                    pending.extend(
+                        executor.submit(self._get_data, rr, filters, 1)
+                        for rr in islice(road_ids, 1)
+                    )
+                    yield df
+            return
+
+        if self.road_ids is not None or self._use_local():
+            yield self.collect(threads)
+            return
+
+        if self.latest:
+            filters.append(_filter("latest", "EqualTo", "L"))
+        for page in self.conn._iter_pages(
+            self.table_name,
+            filters=filters,
+            get_geometry=self.get_geometry,
+            threads=threads,
+        ):
+            if self.columns is not None:
+                geometry_columns = ["wkt"] if self.get_geometry else []
+                page = page[
+                    [
+                        cc
+                        for cc in list(self.columns) + geometry_columns
+                        if cc in page.columns
+                    ]
+                ]
+            yield page
+
+
+def _filter(column, operator, value):
+    return {"columnName": column, "operator": operator, "value": str(value)}
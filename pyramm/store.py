@@ -0,0 +1,593 @@
+import os
+import shutil
+import numpy as np
+import pandas as pd
+import shapely
+
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+from pathlib import Path
+from threading import Lock
+
+from pyramm.constants import DEFAULT_PARQUET_PATH, DEFAULT_SQLITE_PATH
+from pyramm.db import (
+    SqliteWriter,
+    delete_road_id_status_from_sqlite,
+    from_sqlite,
+    read_road_id_status_from_sqlite,
+    read_table_status_from_sqlite,
+    road_ids_in_sqlite,
+    update_road_id_status_in_sqlite,
+    update_table_status_in_sqlite,
+)
+from pyramm.geometry import loads_array
+
+
+TABLE_STATUS_COLUMNS = [
+    "database",
+    "table_name",
+    "full_retrieval",
+    "date_retrieved",
+    "row_count",
+    "source_total",
+]
+ROAD_ID_STATUS_COLUMNS = [
+    "database",
+    "table_name",
+    "road_id",
+    "row_count",
+    "content_hash",
+    "date_retrieved",
+]
+
+FILTER_OPERATORS = {
+    "EqualTo": lambda series, value: series == value,
+    "NotEqualTo": lambda series, value: series != value,
+    "GreaterThan": lambda series, value: series > value,
+    "GreaterThanOrEqualTo": lambda series, value: series >= value,
+    "LessThan": lambda series, value: series < value,
+    "LessThanOrEqualTo": lambda series, value: series <= value,
+}
+
+
+def _filter_values(series, operator, value):
+    values = [value]
+    if operator == "In" and isinstance(value, str):
+        values = value.split(",")
+    if pd.api.types.is_numeric_dtype(series):
+        values = pd.to_numeric(values)
+    return list(values)
+
+
+def content_hash(df):
+    """
+    Hash of the contents of a DataFrame. The hash doesn't depend on the row order
+    or the index.
+
+    """
+    row_hashes = pd.util.hash_pandas_object(df, index=False).to_numpy()
+    return f"{int(row_hashes.sum(dtype=np.uint64)):016x}"
+
+
+def combine_hashes(hashes):
+    """
+    Combine the content hashes of the parts of a DataFrame (e.g. the pages of a
+    streamed table) into the content hash of the whole DataFrame.
+
+    """
+    return f"{sum(int(hh, 16) for hh in hashes) % 2**64:016x}"
+
+
+def apply_filters(df, filters):
+    """
+    Apply RAMM API style filters, e.g.
+    {'columnName': 'latest', 'operator': 'EqualTo', 'value': 'L'}, to a DataFrame
+    read from the local store.
+
+    """
+    for ff in filters:
+        series = df[ff["columnName"]]
+        values = _filter_values(series, ff["operator"], ff["value"])
+        if ff["operator"] == "In":
+            mask = series.isin(values)
+        elif ff["operator"] in FILTER_OPERATORS:
+            mask = FILTER_OPERATORS[ff["operator"]](series, values[0])
+        else:
+            raise ValueError(f"unsupported filter operator '{ff['operator']}'")
+        # Missing values (e.g. in Arrow-backed columns) don't match the filter:
+        df = df.loc[mask.fillna(False).astype(bool)]
+    return df
+
+
+class BaseStore(ABC):
+    """
+    Local mirror of RAMM tables. Subclasses implement the storage backend, the
+    Connection object only interacts with the local mirror through this interface.
+
+    """
+
+    # Number of threads used to write to the store during a pull. Stores that
+    # can't be written to concurrently (e.g. SQLite) use a single writer thread:
+    write_threads = 1
+
+    def __init__(self, path, database="SH New Zealand"):
+        self.path = Path(path).expanduser().absolute()
+        self.database = database
+
+    @abstractmethod
+    def read(
+        self,
+        table_name,
+        columns=None,
+        road_ids=None,
+        start_m=None,
+        end_m=None,
+        bbox=None,
+        dtype_backend=None,
+    ):
+        """
+        Read a table from the local mirror, limited to the requested columns and
+        rows. Returns None if the table isn't present.
+
+        bbox (minx, miny, maxx, maxy) limits the result to features whose bounding
+        box intersects the bbox, in the CRS of the stored geometry. Use
+        dtype_backend="pyarrow" for Arrow-backed dtypes.
+
+        """
+
+    @abstractmethod
+    def road_ids(self, table_name):
+        """Return the road_ids present in a table, or None if the table isn't present."""
+
+    @abstractmethod
+    def write(self, df, table_name):
+        """Replace the entire table."""
+
+    @abstractmethod
+    def replace_road_ids(self, df, table_name, road_ids):
+        """Replace the rows for the given road_ids with the rows in df."""
+
+    @abstractmethod
+    def append(self, df, table_name):
+        """Append rows to a table, the table is created if it doesn't exist."""
+
+    def finalise(self, table_name, indexes=[]):
+        """Called once a pull is complete (e.g. to build indexes)."""
+        pass
+
+    @abstractmethod
+    def read_table_status(self):
+        """
+        Return the retrieval status of the tables (indexed by database and
+        table_name), or None if not available.
+
+        """
+
+    @abstractmethod
+    def update_table_status(self, table_name, entire_table, source_total=None):
+        """
+        Record the retrieval of a table along with the local row count and the
+        number of rows in the source table (source_total).
+
+        """
+
+    @abstractmethod
+    def read_road_id_status(self, table_name):
+        """
+        Return the row count, content hash and retrieval date of each road_id
+        (indexed by road_id), or None if not available.
+
+        """
+
+    @abstractmethod
+    def update_road_id_status(self, table_name, records, replace_all=False):
+        """
+        Upsert the status of individual road_ids. records is a list of dicts with
+        road_id, row_count and content_hash keys.
+
+        """
+
+    @abstractmethod
+    def delete_road_id_status(self, table_name, road_ids):
+        """Remove the status of the given road_ids."""
+
+
+class SqliteStore(BaseStore):
+    """Local mirror stored in a single SQLite database file."""
+
+    def __init__(
+        self,
+        path=DEFAULT_SQLITE_PATH,
+        database="SH New Zealand",
+        geometry_format="wkb",
+        geometry_crs=4326,
+    ):
+        """
+        Geometry is stored as WKB (reprojected to geometry_crs) with an R-tree
+        index, use geometry_format="wkt" to store the WKT strings unchanged.
+
+        """
+        super().__init__(path, database)
+        self.writer = SqliteWriter(
+            self.path, geometry_format=geometry_format, geometry_crs=geometry_crs
+        )
+
+    def read(
+        self,
+        table_name,
+        columns=None,
+        road_ids=None,
+        start_m=None,
+        end_m=None,
+        bbox=None,
+        dtype_backend=None,
+    ):
+        return from_sqlite(
+            table_name,
+            path=self.path,
+            columns=columns,
+            road_ids=road_ids,
+            start_m=start_m,
+            end_m=end_m,
+            bbox=bbox,
+            dtype_backend=dtype_backend,
+        )
+
+    def road_ids(self, table_name):
+        return road_ids_in_sqlite(table_name, path=self.path)
+
+    def write(self, df, table_name):
+        self.writer.write(df, table_name)
+
+    def replace_road_ids(self, df, table_name, road_ids):
+        self.writer.replace_road_ids(df, table_name, road_ids)
+
+    def append(self, df, table_name):
+        self.writer.write(df, table_name, if_exists="append")
+
+    def finalise(self, table_name, indexes=[]):
+        self.writer.create_indexes(table_name, indexes)
+
+    def read_table_status(self):
+        return read_table_status_from_sqlite(path=self.path)
+
+    def update_table_status(self, table_name, entire_table, source_total=None):
+        update_table_status_in_sqlite(
+            self.database,
+            table_name,
+            entire_table,
+            path=self.path,
+            source_total=source_total,
+        )
+
+    def read_road_id_status(self, table_name):
+        return read_road_id_status_from_sqlite(self.database, table_name, self.path)
+
+    def update_road_id_status(self, table_name, records, replace_all=False):
+        update_road_id_status_in_sqlite(
+            self.database, table_name, records, path=self.path, replace_all=replace_all
+        )
+
+    def delete_road_id_status(self, table_name, road_ids):
+        delete_road_id_status_from_sqlite(
+            self.database, table_name, road_ids, path=self.path
+        )
+
+
+def _require_pyarrow(feature="the parquet store"):
+    try:
+        import pyarrow  # noqa
+    except ImportError:
+        raise ImportError(
+            f"pyarrow is required for {feature}, install it using "
+            "'pip install pyramm[parquet]'"
+        )
+
+
+class ParquetStore(BaseStore):
+    """
+    Local mirror stored as a parquet dataset, partitioned by database, table and
+    road_id bucket:
+
+        <path>/<database>/<table_name>/bucket=<nn>/road_id=<road_id>/part-<n>.parquet
+
+    Rows without a road_id are stored in a partition of their own:
+
+        <path>/<database>/<table_name>/bucket=null/road_id=__null__/part-<n>.parquet
+
+    Tables without a road_id column are stored as:
+
+        <path>/<database>/<table_name>/part-<n>.parquet
+
+    Reads with road_ids only open the files for those road_ids.
+
+    """
+
+    n_buckets = 64
+
+    def __init__(self, path=DEFAULT_PARQUET_PATH, database="SH New Zealand", threads=4):
+        _require_pyarrow()
+        super().__init__(path, database)
+        self.threads = threads
+        self.write_threads = threads
+        self._status_lock = Lock()
+
+    def _table_path(self, table_name):
+        return self.path / self.database / table_name
+
+    def _road_id_path(self, table_name, road_id):
+        if pd.isnull(road_id):
+            return self._table_path(table_name) / "bucket=null" / "road_id=__null__"
+        bucket = int(road_id) % self.n_buckets
+        return (
+            self._table_path(table_name)
+            / f"bucket={bucket:02d}"
+            / f"road_id={int(road_id)}"
+        )
+
+    def _road_id_paths(self, table_name):
+        # Skip any temporary partitions that are still being written:
+        return [
+            pp
+            for pp in self._table_path(table_name).glob("bucket=*/road_id=*")
+            if not pp.name.endswith(".tmp")
+        ]
+
+    @staticmethod
+    def _write_partition(df, partition_path):
+        # Write to a temporary directory then swap it into place so readers never
+        # see a partially written partition:
+        temp_path = partition_path.with_name(f"{partition_path.name}.{os.getpid()}.tmp")
+        shutil.rmtree(temp_path, ignore_errors=True)
+        temp_path.mkdir(parents=True)
+        df.to_parquet(temp_path / "part-00000.parquet", index=False)
+        shutil.rmtree(partition_path, ignore_errors=True)
+        os.replace(temp_path, partition_path)
+
+    @staticmethod
+    def _append_part(df, partition_path):
+        # Add the next part file to the partition (written to a hidden temporary
+        # file first so readers never see a partially written part):
+        partition_path.mkdir(parents=True, exist_ok=True)
+        part = f"part-{len(list(partition_path.glob('part-*.parquet'))):05d}.parquet"
+        temp_path = partition_path / f".{part}.{os.getpid()}.tmp"
+        df.to_parquet(temp_path, index=False)
+        os.replace(temp_path, partition_path / part)
+
+    def _read_file(self, path, columns, start_m, end_m, dtype_backend=None):
+        import pyarrow.parquet as pq
+
+        names = pq.read_schema(path).names
+        filters = []
+        if start_m is not None and "end_m" in names:
+            filters.append(("end_m", ">", float(start_m)))
+        if end_m is not None and "start_m" in names:
+            filters.append(("start_m", "<", float(end_m)))
+        return pq.read_table(
+            path,
+            columns=None if columns is None else [cc for cc in columns if cc in names],
+            filters=filters or None,
+        ).to_pandas(types_mapper=pd.ArrowDtype if dtype_backend == "pyarrow" else None)
+
+    def read(
+        self,
+        table_name,
+        columns=None,
+        road_ids=None,
+        start_m=None,
+        end_m=None,
+        bbox=None,
+        dtype_backend=None,
+    ):
+        table_path = self._table_path(table_name)
+        if not table_path.exists():
+            return None
+
+        if road_ids is not None:
+            # Prune partitions using the road_id:
+            partition_paths = [
+                self._road_id_path(table_name, rr) for rr in set(road_ids)
+            ]
+        else:
+            partition_paths = self._road_id_paths(table_name) or [table_path]
+
+        files = sorted(
+            ff
+            for pp in partition_paths
+            if pp.exists()
+            for ff in pp.glob("part-*.parquet")
+        )
+        if len(files) == 0:
+            return self._empty_frame(table_name, columns, dtype_backend)
+
+        with ThreadPoolExecutor(self.threads) as executor:
+            frames = list(
+                executor.map(
+                    lambda ff: self._read_file(
+                        ff, columns, start_m, end_m, dtype_backend
+                    ),
+                    files,
+                )
+            )
+        df = pd.concat(frames, ignore_index=True)
+        if bbox is not None:
+            # No spatial index, filter using the bounds of the WKT geometry (EPSG:4326):
+            bounds = shapely.bounds(loads_array(df["wkt"], 4326, 4326))
+            df = df.loc[
+                (bounds[:, 2] >= bbox[0])
+                & (bounds[:, 3] >= bbox[1])
+                & (bounds[:, 0] <= bbox[2])
+                & (bounds[:, 1] <= bbox[3])
+            ].reset_index(drop=True)
+        if columns is not None:
+            df = df[[cc for cc in columns if cc in df.columns]]
+        return df
+
+    def _empty_frame(self, table_name, columns, dtype_backend=None):
+        # No rows to read, use the columns (and dtypes) of the stored table:
+        import pyarrow.parquet as pq
+
+        part = next(iter(self._files(table_name)), None)
+        if part is None:
+            return pd.DataFrame(columns=columns)
+        df = (
+            pq.read_schema(part)
+            .empty_table()
+            .to_pandas(
+                types_mapper=pd.ArrowDtype if dtype_backend == "pyarrow" else None
+            )
+        )
+        if columns is not None:
+            df = df[[cc for cc in columns if cc in df.columns]]
+        return df
+
+    def road_ids(self, table_name):
+        if not self._table_path(table_name).exists():
+            return None
+        # Like SQLite, None is included when some rows have no road_id:
+        return [
+            None if pp.name == "road_id=__null__" else int(pp.name.split("=")[1])
+            for pp in self._road_id_paths(table_name)
+        ]
+
+    def write(self, df, table_name):
+        table_path = self._table_path(table_name)
+        shutil.rmtree(table_path, ignore_errors=True)
+        if "road_id" not in df.columns:
+            table_path.mkdir(parents=True)
+            df.to_parquet(table_path / "part-00000.parquet", index=False)
+            return
+        self.replace_road_ids(df, table_name, df["road_id"].unique())
+
+    def replace_road_ids(self, df, table_name, road_ids):
+        # Grouped by partition path, as the null road_id doesn't compare equal:
+        groups = {
+            self._road_id_path(table_name, road_id): group
+            for road_id, group in df.groupby("road_id", dropna=False)
+        }
+
+        def replace(road_id):
+            partition_path = self._road_id_path(table_name, road_id)
+            if partition_path in groups:
+                self._write_partition(groups[partition_path], partition_path)
+            else:
+                shutil.rmtree(partition_path, ignore_errors=True)
+
+        with ThreadPoolExecutor(self.threads) as executor:
+            list(executor.map(replace, road_ids))
+
+    def append(self, df, table_name):
+        if "road_id" not in df.columns:
+            self._append_part(df, self._table_path(table_name))
+            return
+        for road_id, group in df.groupby("road_id", dropna=False):
+            self._append_part(group, self._road_id_path(table_name, road_id))
+
+    def _files(self, table_name):
+        return self._table_path(table_name).glob("**/part-*.parquet")
+
+    def _read_status(self, name):
+        path = self.path / f"{name}.parquet"
+        if not path.exists():
+            return None
+        df = pd.read_parquet(path)
+        df["date_retrieved"] = pd.to_datetime(df["date_retrieved"]).dt.date
+        return df
+
+    def _upsert_status(self, name, records, columns, keys, replace=None):
+        # The status files are small, so they are rewritten on each update:
+        with self._status_lock:
+            existing = self._read_status(name)
+            if existing is not None and replace is not None:
+                existing = existing.loc[~replace(existing)]
+            frames = [
+                ff
+                for ff in [existing, pd.DataFrame(records, columns=columns)]
+                if ff is not None and len(ff) > 0
+            ]
+            new = (
+                pd.concat(frames, ignore_index=True)
+                if frames
+                else pd.DataFrame(columns=columns)
+            )
+            new = new.drop_duplicates(keys, keep="last")
+            new["date_retrieved"] = pd.to_datetime(new["date_retrieved"])
+            self.path.mkdir(parents=True, exist_ok=True)
+            new.to_parquet(self.path / f"{name}.parquet", index=False)
+
+    def read_table_status(self):
+        df = self._read_status("_table_status")
+        if df is None:
+            return None
+        return df.set_index(["database", "table_name"])
+
+    def update_table_status(self, table_name, entire_table, source_total=None):
+        import pyarrow.parquet as pq
+
+        row_count = sum(pq.read_metadata(ff).num_rows for ff in self._files(table_name))
+        self._upsert_status(
+            "_table_status",
+            [
+                {
+                    "database": self.database,
+                    "table_name": table_name,
+                    "full_retrieval": bool(entire_table),
+                    "date_retrieved": date.today(),
+                    "row_count": row_count,
+                    "source_total": source_total,
+                }
+            ],
+            columns=TABLE_STATUS_COLUMNS,
+            keys=["database", "table_name"],
+        )
+
+    def read_road_id_status(self, table_name):
+        df = self._read_status("_road_id_status")
+        if df is None:
+            return None
+        df = df.loc[
+            (df["database"] == self.database) & (df["table_name"] == table_name)
+        ]
+        return df.drop(columns=["database", "table_name"]).set_index("road_id")
+
+    def update_road_id_status(self, table_name, records, replace_all=False):
+        def replace(df):
+            return (df["database"] == self.database) & (df["table_name"] == table_name)
+
+        self._upsert_status(
+            "_road_id_status",
+            [
+                {
+                    "database": self.database,
+                    "table_name": table_name,
+                    "road_id": int(rr["road_id"]),
+                    "row_count": int(rr["row_count"]),
+                    "content_hash": rr["content_hash"],
+                    "date_retrieved": date.today(),
+                }
+                for rr in records
+            ],
+            columns=ROAD_ID_STATUS_COLUMNS,
+            keys=["database", "table_name", "road_id"],
+            replace=replace if replace_all else None,
+        )
+
+    def delete_road_id_status(self, table_name, road_ids):
+        road_ids = [int(rr) for rr in road_ids]
+
+        def replace(df):
+            return (
+                (df["database"] == self.database)
+                & (df["table_name"] == table_name)
+                & df["road_id"].isin(road_ids)
+            )
+
+        if self._read_status("_road_id_status") is not None:
+            self._upsert_status(
+                "_road_id_status",
+                [],
+                columns=ROAD_ID_STATUS_COLUMNS,
+                keys=["database", "table_name", "road_id"],
+                replace=replace,
+            )
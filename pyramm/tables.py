@@ -1,12 +1,32 @@
 import warnings
+import numpy as np
+import pandas as pd
 from pandas import DataFrame, to_datetime, read_csv, notnull
+from pandas.api.types import union_categoricals
 
-from pyramm.helpers import _map_json
-from pyramm.geometry import transform, loads
+from pyramm.helpers import _map_json, _to_arrow
+from pyramm.logging import logger
+from pyramm.geometry import loads_array, transform_array
 
 
 DEFAULT_DATE_COLUMNS = ["added_on", "chgd_on"]
 
+# Low cardinality code columns stored as categoricals:
+CATEGORY_COLUMNS = ["lane", "sh_direction", "sh_element_type", "latest"]
+
+# Data types returned by the RAMM schema endpoint (ColumnInfo dataType) and the
+# kind of values they hold. Columns with other data types (e.g. Point) are
+# inferred from the values:
+SCHEMA_DATA_TYPES = {
+    "integer": "integer",
+    "decimal": "float",
+    "double": "float",
+    "datetime": "datetime",
+    "date": "datetime",
+    "boolean": "boolean",
+    "string": "string",
+}
+
 
 class BaseTable:
     table_name = None
@@ -23,6 +43,7 @@ class BaseTable:
 
         self._get_data(ramm, road_id, latest)
         self._convert_dates()
+        self._compact_dtypes(ramm)
         self._replace_nan()
 
         if self.index_name:
@@ -36,14 +57,21 @@ class BaseTable:
             self.get_geometry,
             filters=self.filters.copy(),
         ).copy()
-        if "wkt" in self.df.columns:
+        if "geometry" in self.df.columns:
+            # Geometry already decoded by the local store:
+            crs = self.df.attrs.get("crs", 4326)
+            self.df = self.df.loc[self.df["geometry"].notnull()].reset_index(drop=True)
+            if crs != 2193:
+                self.df["geometry"] = transform_array(self.df["geometry"], crs, 2193)
+        elif "wkt" in self.df.columns:
             # Drop lines with missing geometry:
-            self.df = self.df.loc[self.df["wkt"] != ""].reset_index(drop=True)
+            has_wkt = self.df["wkt"].notnull() & (self.df["wkt"] != "")
+            self.df = self.df.loc[has_wkt.astype(bool)].reset_index(drop=True)
 
             # Parse WKT string to geometry:
             with warnings.catch_warnings():
                 warnings.filterwarnings("ignore")
-                self.df["geometry"] = [transform(loads(ww)) for ww in self.df["wkt"]]
+                self.df["geometry"] = loads_array(self.df["wkt"])
 
     def _convert_dates(self):
         date_columns = set(self.date_columns + DEFAULT_DATE_COLUMNS)
@@ -53,21 +81,113 @@ class BaseTable:
             except KeyError:
                 pass
 
+    def _compact_dtypes(self, ramm):
+        schema = None
+        # Offline connections don't have the schema, the dtypes are inferred:
+        if hasattr(ramm, "table_schema") and not getattr(ramm, "offline", False):
+            try:
+                schema = ramm.table_schema(self.table_name)
+            except Exception as exc:
+                # e.g. offline connections, fall back to inferring the dtypes:
+                logger.debug(f"no schema available for {self.table_name}: {exc}")
+        self.df = compact_dtypes(self.df, schema)
+        if getattr(ramm, "dtype_backend", None) == "pyarrow":
+            self.df = _to_arrow(self.df)
+
     def _replace_nan(self):
-        self.df = self.df.where(notnull(self.df), None)
+        # Typed columns keep their missing value markers (NaN, NA or NaT), only
+        # object columns use None:
+        for cc in self.df.columns[self.df.dtypes == object]:
+            self.df[cc] = self.df[cc].where(notnull(self.df[cc]), None)
 
     @classmethod
-    def from_csv(cls, path):
-        new = cls(None)
-        new.df = read_csv(path, index_col=cls.index_name, float_precision="%g")
-        if "wkt" in new.df.columns:
-            with warnings.catch_warnings():
-                warnings.filterwarnings("ignore")
-                new.df["geometry"] = [transform(loads(ww)) for ww in new.df["wkt"]]
-        new._convert_dates()
+    def from_csv(
+        cls,
+        path,
+        usecols=None,
+        dtype=None,
+        schema=None,
+        chunksize=None,
+        store=None,
+        dtype_backend=None,
+    ):
+        """
+        Load the table from a CSV export (e.g. when the RAMM API is unavailable).
+
+        Parameters
+        ----------
+        path : str or Path
+            CSV file
+        usecols : list[str], optional
+            Only read these columns (must include the index columns)
+        dtype : dict, optional
+            dtypes passed to read_csv, by default derived from the schema
+        schema : TableSchema, optional
+            RAMM table schema (e.g. from Connection.table_schema), used for the
+            read_csv dtypes and to cast the columns to compact dtypes
+        chunksize : int, optional
+            Read the file chunksize rows at a time. Each chunk is converted (compact
+            dtypes and geometry) before the next chunk is read.
+        store : BaseStore, optional
+            Write the rows to the local store one chunk at a time instead of
+            returning a DataFrame. The CSV replaces any existing copy of the table
+            and the number of rows written is returned.
+        dtype_backend : str, optional
+            "pyarrow" for Arrow-backed dtypes
+
+        """
+        if dtype is None and schema is not None:
+            dtype = schema_dtypes(schema)
+        if dtype is not None and usecols is not None:
+            dtype = {kk: vv for kk, vv in dtype.items() if kk in usecols}
+        kwargs = {} if dtype_backend is None else {"dtype_backend": dtype_backend}
+        chunks = read_csv(
+            path, usecols=usecols, dtype=dtype, chunksize=chunksize, **kwargs
+        )
+        if chunksize is None:
+            chunks = [chunks]
+
+        if store is not None:
+            return cls._csv_to_store(chunks, store)
+
+        frames = []
+        for chunk in chunks:
+            # Not using cls(None), the HSD table classes require more arguments:
+            new = cls.__new__(cls)
+            new.df = chunk
+            if "wkt" in new.df.columns:
+                with warnings.catch_warnings():
+                    warnings.filterwarnings("ignore")
+                    new.df["geometry"] = loads_array(new.df["wkt"])
+            new._convert_dates()
+            new.df = compact_dtypes(new.df, schema)
+            frames.append(new.df)
+
+        new = cls.__new__(cls)
+        new.df = _concat_chunks(frames)
+        if dtype_backend == "pyarrow":
+            new.df = _to_arrow(new.df)
         new._replace_nan()
+        if cls.index_name:
+            new.df.set_index(cls.index_name, drop=True, inplace=True)
         return new.df
 
+    @classmethod
+    def _csv_to_store(cls, chunks, store):
+        rows = 0
+        for ii, chunk in enumerate(chunks):
+            if ii == 0:
+                store.write(chunk, cls.table_name)
+            else:
+                store.append(chunk, cls.table_name)
+            rows += len(chunk)
+        store.finalise(cls.table_name, store_indexes(cls.table_name))
+        # The road_id status (row counts and content hashes) recorded by earlier
+        # pulls no longer applies:
+        store.update_road_id_status(cls.table_name, [], replace_all=True)
+        store.update_table_status(cls.table_name, entire_table=True)
+        return rows
+
     @classmethod
     def from_frame(cls, df):
         new = cls(None)
@@ -79,6 +199,162 @@ class BaseTable:
         return new.df
 
 
+def _schema_kind(column_info):
+    # Map the RAMM data type to one of: integer, float, datetime, boolean, string
+    # (or None if the data type isn't known).
+    data_type = getattr(column_info, "data_type", None)
+    if not isinstance(data_type, str):
+        return None
+    kind = SCHEMA_DATA_TYPES.get(data_type.lower())
+    if kind == "float" and getattr(column_info, "decimal_places", None) == 0:
+        return "integer"
+    return kind
+
+
+def _to_integer(series):
+    values = pd.to_numeric(series)
+    if not np.array_equal(values.dropna(), values.dropna().round()):
+        raise ValueError("non-integer values")
+    dtype = "Int64"
+    if values.notnull().any():
+        info = np.iinfo(np.int32)
+        if values.min() >= info.min and values.max() <= info.max:
+            dtype = "Int32"
+    return values.astype(dtype)
+
+
+def _to_float(series, decimals=None):
+    values = pd.to_numeric(series).astype("float64")
+    if decimals is None:
+        return values
+    # float32 is only used where the values survive the round trip at the number
+    # of decimal places defined by the schema:
+    values32 = values.astype("float32")
+    roundtrip = values32.astype("float64").round(int(decimals))
+    if ((roundtrip == values) | values.isnull()).all():
+        return values32
+    return values
+
+
+def _infer_column(series):
+    # Used where the column isn't described by the schema:
+    if series.dtype != object or series.isnull().all():
+        return series
+    inferred = pd.api.types.infer_dtype(series, skipna=True)
+    if inferred == "boolean":
+        return series.astype("boolean")
+    if inferred == "integer":
+        return _to_integer(series)
+    if inferred in ["floating", "mixed-integer-float", "decimal"]:
+        return _to_float(series)
+    return series
+
+
+def schema_dtypes(schema):
+    """
+    Return the read_csv dtypes for the columns described by a TableSchema. Dates
+    are left to compact_dtypes.
+
+    """
+    dtypes = {}
+    for cc in schema:
+        kind = _schema_kind(cc)
+        if cc.column_name in CATEGORY_COLUMNS:
+            dtypes[cc.column_name] = "category"
+        elif kind == "integer":
+            dtypes[cc.column_name] = "Int64"
+        elif kind == "float":
+            dtypes[cc.column_name] = "float64"
+        elif kind == "boolean":
+            dtypes[cc.column_name] = "boolean"
+        elif kind == "string":
+            dtypes[cc.column_name] = object
+    return dtypes
+
+
+def cast_to_schema(df, schema):
+    """
+    Cast the object columns of a page of rows with a numeric or boolean data type
+    in the schema. Tables written a page at a time take their column types from
+    the first page, so e.g. a numeric column that is all null in the first page
+    mustn't be written as text.
+
+    """
+    columns = {cc.column_name: cc for cc in schema}
+    df = df.copy(deep=False)
+    for cc in df.columns:
+        if cc not in columns or df[cc].dtype != object:
+            continue
+        kind = _schema_kind(columns[cc])
+        try:
+            if kind == "integer":
+                df[cc] = _to_integer(df[cc])
+            elif kind == "float":
+                df[cc] = _to_float(df[cc])
+            elif kind == "boolean":
+                df[cc] = df[cc].astype("boolean")
+        except (ValueError, TypeError) as exc:
+            logger.debug(f"unable to cast {cc} to the schema dtype: {exc}")
+    return df
+
+
+def _concat_chunks(frames):
+    # pd.concat falls back to object dtype for categoricals with different
+    # categories, combine the categories instead:
+    if len(frames) == 1:
+        return frames[0]
+    df = pd.concat(frames, ignore_index=True)
+    for cc in frames[0].columns:
+        if isinstance(frames[0][cc].dtype, pd.CategoricalDtype) and not isinstance(
+            df[cc].dtype, pd.CategoricalDtype
+        ):
+            df[cc] = union_categoricals([ff[cc] for ff in frames])
+    return df
+
+
+def compact_dtypes(df, schema=None):
+    """
+    Cast the columns of a RAMM table to compact dtypes using the table schema
+    (where available):
+      - integers to nullable integers (Int32 where the values fit),
+      - decimals to float32 where the values survive the round trip at the number
+        of decimal places in the schema (otherwise float64). Positions and
+        lengths in metres (*_m columns) are kept as float64,
+      - dates to datetime64,
+      - low cardinality code columns (CATEGORY_COLUMNS) to categoricals.
+
+    Columns without a (recognised) data type in the schema are inferred from the
+    values. Columns that can't be converted are left unchanged.
+
+    """
+    df = df.copy()
+    columns = {} if schema is None else {cc.column_name: cc for cc in schema}
+    for cc in df.columns:
+        series = df[cc]
+        kind = _schema_kind(columns[cc]) if cc in columns else None
+        try:
+            if cc in CATEGORY_COLUMNS and pd.api.types.is_string_dtype(series.dtype):
+                df[cc] = series.astype("category")
+            elif kind == "integer":
+                df[cc] = _to_integer(series)
+            elif kind == "float":
+                decimals = getattr(columns[cc], "decimal_places", None)
+                if cc.endswith("_m"):
+                    # Positions and lengths in metres need sub-metre precision on
+                    # long roads, so are kept as float64:
+                    decimals = None
+                df[cc] = _to_float(series, decimals)
+            elif kind == "datetime":
+                df[cc] = to_datetime(series)
+            elif kind == "boolean":
+                df[cc] = series.astype("boolean")
+            elif kind is None:
+                df[cc] = _infer_column(series)
+        except (ValueError, TypeError) as exc:
+            logger.debug(f"unable to convert {cc} to a compact dtype: {exc}")
+    return df
+
+
 class Roadnames(BaseTable):
     table_name = "roadnames"
     index_name = "road_id"
@@ -214,6 +490,55 @@ class SkidResistance(HsdTable):
     hdr_table_cls = SkidResistanceHdr
 
 
+def _table_classes(cls=BaseTable):
+    for subclass in cls.__subclasses__():
+        yield subclass
+        yield from _table_classes(subclass)
+
+
+def table_index_columns(table_name):
+    """
+    Return the index columns used by the table classes for a RAMM table. Each entry
+    is a list of column names.
+
+    """
+    indexes = []
+    for cls in _table_classes():
+        if cls.table_name != table_name or not cls.index_name:
+            continue
+        columns = cls.index_name
+        columns = [columns] if isinstance(columns, str) else list(columns)
+        if columns not in indexes:
+            indexes.append(columns)
+    return indexes
+
+
+def store_indexes(table_name):
+    """
+    Return the indexes created on a RAMM table in the local store (by a pull or
+    from_csv): road_id followed by the index columns used by the table classes.
+    Each entry is a list of column names.
+
+    """
+    indexes = [["road_id"]]
+    for columns in table_index_columns(table_name):
+        if columns not in indexes:
+            indexes.append(columns)
+    return indexes
+
+
+def hdr_table_name(table_name):
+    """
+    Return the name of the header table (holding the survey dates) of a high speed
+    data table, or None if the table doesn't have a header table.
+
+    """
+    for cls in _table_classes(HsdTable):
+        if cls.table_name == table_name and cls.hdr_table_cls is not None:
+            return cls.hdr_table_cls.table_name
+    return None
+
+
 class Schema:
     def __iter__(self):
         yield from self.__dict__.values()
@@ -0,0 +1,157 @@
+import pandas as pd
+import pytest
+import sqlite3
+
+from pyramm.db import (
+    SqliteWriter,
+    from_sqlite,
+    replace_road_ids_in_sqlite,
+    road_ids_in_sqlite,
+    to_sqlite,
+)
+from pyramm.tables import store_indexes, table_index_columns
+
+
+def test_replace_road_ids_in_sqlite(tmp_path):
+    path = tmp_path / "test.sqlite"
+    to_sqlite(
+        pd.DataFrame({"road_id": [1, 1, 2, 3], "value": [10, 11, 20, 30]}),
+        "hsd_rough",
+        path=path,
+    )
+
+    replace_road_ids_in_sqlite(
+        pd.DataFrame({"road_id": [2, 2], "value": [21, 22]}),
+        "hsd_rough",
+        [2],
+        path=path,
+    )
+
+    df = from_sqlite("hsd_rough", path=path).sort_values(["road_id", "value"])
+    assert df["road_id"].to_list() == [1, 1, 2, 2, 3]
+    assert df["value"].to_list() == [10, 11, 21, 22, 30]
+
+    with sqlite3.connect(path) as connection:
+        indexes = connection.execute("PRAGMA index_list('hsd_rough');").fetchall()
+    assert "ix_hsd_rough_road_id" in [ii[1] for ii in indexes]
+
+
+def test_replace_road_ids_in_sqlite_new_table(tmp_path):
+    path = tmp_path / "test.sqlite"
+    replace_road_ids_in_sqlite(
+        pd.DataFrame({"road_id": [5], "value": [50]}), "hsd_rough", [5], path=path
+    )
+    assert from_sqlite("hsd_rough", path=path)["value"].to_list() == [50]
+
+
+def test_from_sqlite_filters(tmp_path):
+    path = tmp_path / "test.sqlite"
+    to_sqlite(
+        pd.DataFrame(
+            {
+                "road_id": [1, 1, 2, 3],
+                "start_m": [0, 100, 0, 0],
+                "end_m": [100, 200, 50, 80],
+                "value": [10, 11, 20, 30],
+            }
+        ),
+        "hsd_rough",
+        path=path,
+    )
+
+    df = from_sqlite("hsd_rough", path=path, columns=["road_id", "value"], road_id=1)
+    assert list(df.columns) == ["road_id", "value"]
+    assert df["value"].to_list() == [10, 11]
+
+    df = from_sqlite("hsd_rough", path=path, road_ids=[1, 2], start_m=60, end_m=150)
+    assert df["value"].to_list() == [10, 11]
+
+    chunks = list(from_sqlite("hsd_rough", path=path, chunksize=3))
+    assert [len(cc) for cc in chunks] == [3, 1]
+
+    assert sorted(road_ids_in_sqlite("hsd_rough", path=path)) == [1, 2, 3]
+    assert road_ids_in_sqlite("missing", path=path) is None
+    assert from_sqlite("missing", path=path) is None
+
+
+def test_sqlite_writer_create_indexes(tmp_path):
+    path = tmp_path / "test.sqlite"
+    writer = SqliteWriter(path, batch_size=2)
+    writer.write(
+        pd.DataFrame({"road_id": [1, 2, 3], "start_m": [0, 0, 0], "end_m": [1, 1, 1]}),
+        "hsd_rough",
+    )
+    writer.create_indexes(
+        "hsd_rough", ["road_id", ["road_id", "start_m", "end_m"], ["missing"]]
+    )
+
+    with sqlite3.connect(path) as connection:
+        indexes = [
+            ii[1]
+            for ii in connection.execute("PRAGMA index_list('hsd_rough');").fetchall()
+        ]
+        journal_mode = connection.execute("PRAGMA journal_mode;").fetchone()[0]
+    assert sorted(indexes) == [
+        "ix_hsd_rough_road_id",
+        "ix_hsd_rough_road_id_start_m_end_m",
+    ]
+    assert journal_mode == "wal"
+    assert len(from_sqlite("hsd_rough", path=path)) == 3
+
+
+def test_table_index_columns():
+    assert table_index_columns("roadnames") == [["road_id"]]
+    assert table_index_columns("hsd_rough") == [
+        ["survey_number", "road_id", "lane", "start_m", "end_m"]
+    ]
+    assert table_index_columns("ud_surface_layer") == []
+
+
+def test_store_indexes():
+    # The same indexes are created by pull and from_csv:
+    assert store_indexes("roadnames") == [["road_id"]]
+    assert store_indexes("hsd_rough") == [
+        ["road_id"],
+        ["survey_number", "road_id", "lane", "start_m", "end_m"],
+    ]
+
+
+def test_sqlite_writer_wkb_rtree(tmp_path):
+    path = tmp_path / "test.sqlite"
+    df = pd.DataFrame(
+        {
+            "road_id": [1, 1, 2],
+            "carr_way_no": [1, 2, 3],
+            "wkt": [
+                "LINESTRING (172.6 -43.4, 172.61 -43.41)",
+                "",
+                "LINESTRING (174 -41, 174.1 -41.1)",
+            ],
+        }
+    )
+    writer = SqliteWriter(path)
+    writer.write(df, "carr_way")
+    writer.replace_road_ids(df.iloc[[2]].assign(carr_way_no=4), "carr_way", [2])
+
+    new = from_sqlite("carr_way", path=path)
+    assert "wkt" not in new.columns
+    assert new.attrs["crs"] == 4326
+    assert new["geometry"].isnull().to_list() == [False, True, False]
+
+    new = from_sqlite("carr_way", path=path, bbox=(173.9, -41.2, 174.2, -40.9))
+    assert new["carr_way_no"].to_list() == [4]
+
+    new = from_sqlite(
+        "carr_way", path=path, bbox=(1.56e6, 5.18e6, 1.58e6, 5.20e6), bbox_crs=2193
+    )
+    assert new["carr_way_no"].to_list() == [1]
+
+
+def test_sqlite_writer_wkb_projected(tmp_path):
+    path = tmp_path / "test.sqlite"
+    df = pd.DataFrame({"carr_way_no": [1], "wkt": ["POINT (172.6 -43.4)"]})
+    SqliteWriter(path, geometry_crs=2193).write(df, "carr_way")
+
+    new = from_sqlite("carr_way", path=path)
+    assert new.attrs["crs"] == 2193
+    assert new["geometry"][0].x == pytest.approx(1567609, abs=1)
@@ -1,9 +1,11 @@
 import pytest
+import numpy as np
 import pandas as pd
 from pandas.testing import assert_frame_equal
-from shapely.geometry import Point, MultiPoint
+from shapely.geometry import LineString, Point, MultiPoint
 
 from pyramm.geometry import (
+    Centreline,
     build_partial_centreline,
     combine_continuous_segments,
     build_chainage_layer,
@@ -11,6 +13,260 @@ from pyramm.geometry import (
 )
 
 
+@pytest.fixture
+def simple_centreline():
+    # Small network in NZTM2000 (EPSG:2193) coordinates:
+    x0, y0 = 1570000, 5180000
+    records = [
+        (10, 1, 0, 100, [(x0, y0), (x0 + 100, y0)]),
+        (11, 1, 100, 200, [(x0 + 100, y0), (x0 + 100, y0 + 100)]),
+        (20, 2, 0, 140, [(x0, y0 + 50), (x0 + 50, y0 + 50), (x0 + 50, y0 + 150)]),
+    ]
+    df = pd.DataFrame(
+        [
+            {
+                "carr_way_no": carr_way_no,
+                "road_id": road_id,
+                "carrway_start_m": start_m,
+                "carrway_end_m": end_m,
+                "length_m": end_m - start_m,
+                "geometry": LineString(coords),
+            }
+            for carr_way_no, road_id, start_m, end_m, coords in records
+        ]
+    ).set_index("carr_way_no")
+    return Centreline(df)
+
+
+@pytest.fixture
+def simple_points():
+    rng = np.random.default_rng(1)
+    return 1570000 + rng.uniform(-20, 120, 50), 5180000 + rng.uniform(-20, 170, 50)
+
+
+@pytest.mark.parametrize("road_id", [None, 1, 2])
+def test_position_many(simple_centreline, simple_points, road_id):
+    x, y = simple_points
+    result = simple_centreline.position_many(x, y, point_crs=2193, road_id=road_id)
+    assert len(result) == len(x)
+    for ii in range(len(x)):
+        expected = simple_centreline.position(
+            Point(x[ii], y[ii]), point_crs=2193, road_id=road_id
+        )
+        assert result["road_id"][ii] == expected["road_id"]
+        assert result["position_m"][ii] == pytest.approx(expected["position_m"])
+        assert result["search_offset_m"][ii] == pytest.approx(
+            expected["search_offset_m"]
+        )
+
+
+def test_build_point_layer(simple_centreline):
+    from pyramm.geometry import _build_point_layer
+
+    df = simple_centreline._df_features
+    points, features = _build_point_layer(df, dx=2)
+    expected = [
+        (carr_way_no, row["road_id"], row["geometry"].interpolate(x))
+        for carr_way_no, row in df.iterrows()
+        for x in range(2, int(row["geometry"].length), 2)
+    ]
+    assert points.shape == (len(expected), 2)
+    assert list(df.index[features]) == [ee[0] for ee in expected]
+    assert list(df["road_id"].iloc[features]) == [ee[1] for ee in expected]
+    assert np.allclose(points, [ee[2].coords[0] for ee in expected])
+
+
+@pytest.mark.parametrize("road_id,carr_way_no", [(None, 10), (2, 20)])
+def test_nearest_feature_kdtree_simple(simple_centreline, road_id, carr_way_no):
+    point = Point(1570031, 5180021)
+    result = simple_centreline.nearest_feature(
+        point, point_crs=2193, road_id=road_id, method="kdtree"
+    )
+    assert result[0] == carr_way_no
+    assert result[1] == pytest.approx(21 if road_id is None else 29)
+
+
+@pytest.mark.parametrize(
+    "xy,road_id,carr_way_no,offset_m",
+    [
+        # Nearest to the vertex shared by 10 and 11, the first feature is used:
+        ((1570105, 5179995), None, 10, 50**0.5),
+        # Equally near to road_id 1 and 2:
+        ((1570025, 5180025), None, 10, 25),
+        ((1570025, 5180025), 2, 20, 25),
+        ((1570075, 5180040), None, 11, 25),
+    ],
+)
+def test_nearest_feature_shortest_line_ties(
+    simple_centreline, xy, road_id, carr_way_no, offset_m
+):
+    result = simple_centreline.nearest_feature_shortest_line(Point(xy), road_id)
+    assert result[0] == carr_way_no
+    assert result[1] == pytest.approx(offset_m)
+
+
+def test_index_cache(simple_centreline):
+    import pickle
+
+    point = Point(1570031, 5180021)
+    for _ in range(3):
+        for road_id in [1, 2]:
+            simple_centreline.nearest_feature(point, 2193, road_id)
+            simple_centreline.nearest_feature(point, 2193, road_id, method="kdtree")
+    cache = simple_centreline.index_cache
+    assert len(cache) == 4
+    assert (cache.hits, cache.misses) == (8, 4)
+    assert cache.nbytes > 0
+
+    # Only the most recently used index is kept if the limit is exceeded:
+    cache.max_bytes = 1
+    simple_centreline.nearest_feature(point, 2193, 1)
+    assert len(cache) == 1 and ("strtree", 1) in cache
+
+    cache = pickle.loads(pickle.dumps(simple_centreline)).index_cache
+    assert len(cache) == 0 and cache.max_bytes == 1
+
+
+def test_append_geometry_simple(simple_centreline):
+    df = pd.DataFrame(
+        {
+            "road_id": [1, 1, 2, 3],
+            "start_m": [50, 120, 0, 0],
+            "end_m": [150, 180, 140, 10],
+        }
+    )
+    df = simple_centreline.append_geometry(df)
+    assert df["wkt"].tolist() == [
+        "LINESTRING (1570050 5180000, 1570100 5180000, 1570100 5180050)",
+        "LINESTRING (1570100 5180020, 1570100 5180080)",
+        "LINESTRING (1570000 5180050, 1570050 5180050, 1570050 5180150)",
+        None,
+    ]
+
+    df = simple_centreline.append_geometry(df, geometry_type="coord")
+    assert df["easting"].tolist()[:3] == [1570050, 1570100, 1570000]
+    assert np.isnan(df["northing"].iloc[3])
+
+
+@pytest.mark.parametrize(
+    "xy,carr_way_no",
+    [
+        ([(1570060, 5180120)], [20]),
+        ([(1570060, 5180120), (1570095, 5180005)], [10, 11, 20]),
+        ([(1570200, 5180300)], []),
+    ],
+)
+def test_build_limited_centreline_simple(simple_centreline, xy, carr_way_no):
+    limited_centreline = simple_centreline.build_limited_centreline(
+        MultiPoint(xy), point_crs=2193, buffer_distance_m=10
+    )
+    assert list(limited_centreline._df_features.index) == carr_way_no
+
+
+@pytest.mark.parametrize("mmap", [True, False])
+def test_centreline_save_load(simple_centreline, simple_points, tmp_path, mmap):
+    simple_centreline.save(tmp_path / "centreline")
+    loaded = Centreline.load(tmp_path / "centreline", mmap=mmap)
+    assert isinstance(loaded._points, np.memmap) == mmap
+    assert_frame_equal(
+        loaded._df_features.drop(columns="geometry"),
+        simple_centreline._df_features.drop(columns="geometry"),
+    )
+    assert all(
+        aa.equals_exact(bb, tolerance=0)
+        for aa, bb in zip(
+            loaded._df_features["geometry"], simple_centreline._df_features["geometry"]
+        )
+    )
+
+    x, y = simple_points
+    assert_frame_equal(
+        loaded.position_many(x, y, point_crs=2193),
+        simple_centreline.position_many(x, y, point_crs=2193),
+    )
+    point = Point(1570031, 5180021)
+    assert loaded.nearest_feature(point, 2193, 2, method="kdtree") == pytest.approx(
+        simple_centreline.nearest_feature(point, 2193, 2, method="kdtree")
+    )
+    df = pd.DataFrame({"road_id": [1, 2], "start_m": [50, 0], "end_m": [150, 140]})
+    assert_frame_equal(
+        loaded.append_geometry(df.copy()), simple_centreline.append_geometry(df.copy())
+    )
+
+
+def test_centreline_save_without_points(simple_centreline, tmp_path):
+    # Saving over a centreline saved with the points doesn't leave the old points:
+    simple_centreline.save(tmp_path / "centreline")
+    simple_centreline.save(tmp_path / "centreline", include_points=False)
+    assert not (tmp_path / "centreline" / "points.npy").exists()
+    loaded = Centreline.load(tmp_path / "centreline")
+    assert loaded._points is None
+
+    point = Point(1570031, 5180021)
+    assert loaded.nearest_feature(point, 2193, 2, method="kdtree") == pytest.approx(
+        simple_centreline.nearest_feature(point, 2193, 2, method="kdtree")
+    )
+
+
+@pytest.mark.parametrize("road_id", [None, "array"])
+def test_position_many_workers(simple_centreline, simple_points, road_id):
+    x, y = simple_points
+    if road_id == "array":
+        road_id = np.where(np.arange(len(x)) % 2, 1, 2)
+    expected = simple_centreline.position_many(x, y, point_crs=2193, road_id=road_id)
+    result = simple_centreline.position_many(
+        x, y, point_crs=2193, road_id=road_id, workers=2
+    )
+    assert_frame_equal(result, expected)
+
+
+def test_match_trace(simple_centreline):
+    # Trace along road_id 1 with a point nearer to road_id 2 and a missing point:
+    x = 1570000 + np.array([0, 10, 20, 30, 40, 50, 60, np.nan, 80, 90, 98, 102])
+    y = 5180000 + np.array([2, 2, 2, 2, 26, 2, 2, np.nan, 2, 2, 10, 20])
+    assert simple_centreline.position_many(x, y, point_crs=2193)["road_id"][4] == 2
+
+    result = simple_centreline.match_trace(x, y, point_crs=2193)
+    assert result["road_id"].isna().tolist() == [False] * 7 + [True] + [False] * 4
+    assert (result["road_id"].dropna() == 1).all()
+    assert result["position_m"].dropna().tolist() == pytest.approx(
+        [0, 10, 20, 30, 40, 50, 60, 80, 90, 110, 120]
+    )
+    assert result["search_offset_m"][4] == pytest.approx(26)
+
+
+def test_match_trace_search(simple_centreline):
+    # Along road_id 1 then along road_id 2, 50 m to the north:
+    x = 1570000 + np.array([0, 10, 20, 30, 10, 20, 30])
+    y = 5180000 + np.array([2, 2, 2, 2, 51, 51, 51])
+    feature_tree = simple_centreline._feature_tree
+    searches = []
+
+    def counted(road_id=None):
+        searches.append(road_id)
+        return feature_tree(road_id)
+
+    simple_centreline._feature_tree = counted
+    result = simple_centreline.match_trace(x, y, point_crs=2193)
+    assert result["road_id"].tolist() == [1, 1, 1, 1, 2, 2, 2]
+    # All the features are only searched for the first point and where the
+    # trace leaves road_id 1:
+    assert searches == [None, 1, 1, 1, 1, None, 2, 2]
+
+
+def test_position_many_geoseries(simple_centreline, simple_points):
+    geopandas = pytest.importorskip("geopandas")
+
+    x, y = simple_points
+    points = geopandas.GeoSeries(
+        geopandas.points_from_xy(x, y), crs=2193, index=range(100, 150)
+    ).to_crs(4326)
+    result = simple_centreline.position_many(points)
+    expected = simple_centreline.position_many(x, y, point_crs=2193)
+    assert list(result.index) == list(range(100, 150))
+    assert np.allclose(result["position_m"], expected["position_m"])
+
+
 @pytest.mark.parametrize(
     "point,lengths,road_id,position_m",
     [
@@ -226,3 +482,45 @@ def test_extract_geometry_ends_only(centreline):
     assert geometry.coords[-1] == pytest.approx(
         (1564189.0309959787, 5186187.792160582),
     )
+
+
+def test_loads_array():
+    from pyramm.geometry import loads, loads_array, transform
+
+    wkt = [
+        "LINESTRING (172.6 -43.45, 172.61 -43.46)",
+        "",
+        None,
+        "POINT (172.63 -43.43)",
+    ]
+    geometry = loads_array(pd.Series(wkt, index=[5, 6, 7, 8]))
+    assert geometry[1] is None and geometry[2] is None
+    for ii in [0, 3]:
+        assert geometry[ii].equals_exact(transform(loads(wkt[ii])), tolerance=1e-6)
+
+
+def test_transform_array():
+    from pyramm.geometry import transform, transform_array, transform_coords
+
+    geometry = [
+        LineString([(172.6, -43.45), (172.61, -43.46), (172.62, -43.44)]),
+        None,
+        Point(172.63, -43.43),
+        MultiPoint([(172.6, -43.4), (172.7, -43.5)]),
+    ]
+    result = transform_array(geometry, chunk_size=2)
+    assert result[1] is None
+    for ii in [0, 2, 3]:
+        assert result[ii].geom_type == geometry[ii].geom_type
+        assert result[ii].equals_exact(transform(geometry[ii]), tolerance=1e-6)
+
+    x, y = transform_coords([172.6, np.nan], [-43.45, -43.45])
+    assert (x[0], y[0]) == pytest.approx(result[0].coords[0])
+    assert np.isnan(x[1]) and np.isnan(y[1])
+
+    geopandas = pytest.importorskip("geopandas")
+    series = geopandas.GeoSeries(geometry, index=[3, 4, 5, 6], crs=4326)
+    result_series = transform_array(series, from_crs=None)
+    assert result_series.crs.to_epsg() == 2193
+    assert list(result_series.index) == [3, 4, 5, 6]
+    assert result_series.iloc[0].equals_exact(result[0], tolerance=1e-6)
@@ -3,7 +3,7 @@ import pandas as pd
 from shapely.geometry.point import Point
 
 import pyramm
-from pyramm.api import TableRemovedError, parse_filters
+from pyramm.api import Connection, TableRemovedError, parse_filters
 from pyramm.geometry import Centreline
 
 
@@ -144,3 +144,515 @@ class TestCentreline:
         wkt = Centreline._extract_wkt_from_list_of_geometry_objects(geometry)
 
         assert wkt == ["POINT (0 0)", "POINT (1 2)", None]
+
+
+def test_compact_dtypes():
+    from pyramm.tables import TableSchema, _schema_kind, compact_dtypes
+
+    df = pd.DataFrame(
+        {
+            "road_id": [1, 2, None],
+            "start_m": [0.0, 10.5, 20.25],
+            "lane": ["L1", "R1", None],
+            "iri": [1.23, None, 2.5],
+            "reading_date": ["2020-01-01", None, "2021-06-30"],
+            "survey_number": pd.Series([5, 6, 7], dtype=object),
+            "notes": ["a", None, "b"],
+            "length": [1.0, 2.0, None],
+        }
+    )
+    schema = TableSchema.from_schema(
+        [
+            {"columnName": "road_id", "dataType": "Integer"},
+            {"columnName": "start_m", "dataType": "Decimal", "decimalPlaces": 2},
+            {"columnName": "iri", "dataType": "Decimal", "decimalPlaces": 2},
+            {"columnName": "reading_date", "dataType": "DateTime"},
+            {"columnName": "length", "dataType": "Decimal", "decimalPlaces": 0},
+            {"columnName": "location", "dataType": "Point"},
+        ]
+    )
+    # Only the known data types are mapped:
+    assert _schema_kind(schema.location) is None
+    df = compact_dtypes(df, schema)
+    assert df["road_id"].dtype == "Int32"
+    assert df["road_id"].isnull().iloc[2]
+    # Positions in metres aren't downcast:
+    assert df["start_m"].dtype == "float64"
+    assert df["iri"].dtype == "float32"
+    assert df["lane"].dtype == "category"
+    assert pd.api.types.is_datetime64_any_dtype(df["reading_date"])
+    # Not in the schema, inferred from the values:
+    assert df["survey_number"].dtype == "Int32"
+    assert df["notes"].dtype == object
+    assert df["length"].dtype == "Int32"
+
+
+def test_prewarm():
+    from pyramm.cache import prewarm
+
+    class DummyConnection:
+        def __init__(self):
+            self.calls = []
+
+        def roadnames(self):
+            self.calls.append("roadnames")
+
+        def centreline(self):
+            self.calls.append("centreline")
+
+        def get_data(self, table_name):
+            if table_name == "missing":
+                raise ValueError(table_name)
+            self.calls.append(table_name)
+
+    conn = DummyConnection()
+    failed = prewarm(conn, tables=["centreline", "roadnames", "hsd_rough", "missing"])
+
+    assert failed == ["missing"]
+    assert set(conn.calls) == {"roadnames", "hsd_rough", "centreline"}
+    assert conn.calls[-1] == "centreline"
+
+
+def test_prewarm_more_tables_than_workers():
+    from unsync import unsync
+
+    from pyramm.cache import prewarm
+
+    @unsync
+    def _get_page(table_name):
+        return table_name
+
+    class DummyConnection:
+        def get_data(self, table_name):
+            # Like Connection.get_data, wait for page requests on the unsync pool:
+            return _get_page(table_name).result()
+
+    tables = [f"table_{ii}" for ii in range(40)]
+    assert prewarm(DummyConnection(), tables=tables) == []
+
+
+class TestLocalConnection:
+    @pytest.fixture
+    def local_conn(self, tmp_path):
+        from pyramm.api import Connection
+        from pyramm.store import SqliteStore
+
+        store = SqliteStore(tmp_path / "test.sqlite")
+        store.write(
+            pd.DataFrame({"road_id": [1, 2], "road_name": ["A", "B"]}), "roadnames"
+        )
+        store.update_table_status("roadnames", True)
+        store.replace_road_ids(
+            pd.DataFrame(
+                {"road_id": [1, 1, 1], "latest": ["L", "L", "H"], "value": [1, 2, 3]}
+            ),
+            "hsd_rough",
+            [1],
+        )
+        store.update_table_status("hsd_rough", False)
+        return Connection.local(store=store)
+
+    def test_roadnames(self, local_conn):
+        # The dtypes of offline tables are inferred without requesting the schema:
+        local_conn.table_schema = lambda table_name: pytest.fail("schema requested")
+        df = local_conn.roadnames()
+        assert df.index.name == "road_id"
+        assert df["road_name"].to_list() == ["A", "B"]
+
+    def test_get_data(self, local_conn):
+        df = local_conn.get_data("hsd_rough", road_id=1, latest=True)
+        assert df["value"].to_list() == [1, 2]
+
+    def test_table_query(self, local_conn):
+        query = local_conn.table("hsd_rough").where(road_id=[1, 2], latest=True)
+        query = query.select(["road_id", "value"])
+        assert query.plan()["source"] == "local"
+        df = query.collect()
+        assert list(df.columns) == ["road_id", "value"]
+        assert df["value"].to_list() == [1, 2]
+        assert [len(df) for df in query.iter()] == [2, 0]
+
+        df = local_conn.table("hsd_rough").where(value=[2, 3]).collect()
+        assert df["value"].to_list() == [2, 3]
+        # The road_id conditions don't overlap:
+        df = local_conn.table("hsd_rough").where(road_id=1).where(road_id=2).collect()
+        assert len(df) == 0
+
+    def test_arrow_dtypes(self, local_conn):
+        pytest.importorskip("pyarrow")
+        from pyramm.api import Connection
+
+        conn = Connection.local(store=local_conn.store, dtype_backend="pyarrow")
+        df = conn.get_data("hsd_rough", road_id=1, latest=True)
+        assert df["value"].to_list() == [1, 2]
+        assert all(isinstance(dd, pd.ArrowDtype) for dd in df.dtypes)
+        roadnames = conn.roadnames()
+        assert isinstance(roadnames["road_name"].dtype, pd.ArrowDtype)
+
+        # Tables with WKB geometry:
+        conn.store.write(
+            pd.DataFrame({"road_id": [1, 1], "wkt": ["POINT (172 -43)", None]}),
+            "carr_way",
+        )
+        conn.store.update_table_status("carr_way", True)
+        df = conn.get_data("carr_way", get_geometry=True)
+        assert df["road_id"].dtype == "int64[pyarrow]"
+        assert df["geometry"].to_list() == [Point(172, -43), None]
+
+    def test_frame_from_rows(self):
+        pytest.importorskip("pyarrow")
+        from pyramm.helpers import _frame_from_rows
+
+        df = _frame_from_rows(
+            [[1, "a", None, 1.5], [None, "b", None, "x"]],
+            ["road_id", "lane", "empty", "mixed"],
+            "pyarrow",
+        )
+        assert df["road_id"].dtype == "int64[pyarrow]"
+        assert df["road_id"].isnull().to_list() == [False, True]
+        assert df["lane"].dtype == "string[pyarrow]"
+        assert df["mixed"].dtype == object
+
+    def test_not_available(self, local_conn):
+        from pyramm.api import LocalDataError, LoginError
+
+        with pytest.raises(LocalDataError):
+            local_conn.get_data("carr_way")
+        with pytest.raises(LoginError):
+            local_conn.column_names("carr_way")
+
+
+class TestPull:
+    class FakeConnection(Connection):
+        """Connection serving data from a dict of DataFrames (by road_id)."""
+
+        def __init__(self, store, data):
+            self._setup("test", store.path, store, True, False, None)
+            self.data = data
+            self.requested = []
+
+        def column_names(self, table_name):
+            return ["road_id", "value"]
+
+        def table_schema(self, table_name):
+            from pyramm.tables import TableSchema
+
+            return TableSchema.from_schema(
+                [
+                    {"columnName": "road_id", "dataType": "Integer"},
+                    {"columnName": "value", "dataType": "Integer"},
+                    {"columnName": "iri", "dataType": "Decimal", "decimalPlaces": 2},
+                ]
+            )
+
+        def roadnames(self):
+            return pd.DataFrame(index=pd.Index(list(self.data), name="road_id"))
+
+        def _geometry_table(self, table_name):
+            return False
+
+        def _rows(self, table_name, filters=[]):
+            if filters:
+                return len(self.data[int(filters[0]["value"])])
+            return sum(len(df) for df in self.data.values())
+
+        def _get_page(self, table_name, filters, get_geometry, skip, take):
+            road_id = int(filters[0]["value"]) if filters else None
+            if skip == 0:
+                self.requested.append(road_id)
+            if road_id is None:
+                df = pd.concat(self.data.values(), ignore_index=True)
+            else:
+                df = self.data[road_id]
+            return df.iloc[skip : skip + take]
+
+    @pytest.fixture
+    def data(self):
+        return {
+            rr: pd.DataFrame({"road_id": [rr] * rr, "value": range(rr)})
+            for rr in [1, 2, 3]
+        }
+
+    def test_pull(self, tmp_path, data):
+        from pyramm.store import SqliteStore
+
+        store = SqliteStore(tmp_path / "test.sqlite", database="test")
+        conn = self.FakeConnection(store, data)
+        conn.pull("hsd_rough", incremental_download=True)
+        assert conn.requested == [1, 2, 3]
+
+        status = store.read_table_status().loc[("test", "hsd_rough")]
+        assert status["full_retrieval"]
+        assert status["row_count"] == 6
+        assert status["source_total"] == 6
+        assert store.read_road_id_status("hsd_rough")["row_count"].to_dict() == {
+            1: 1,
+            2: 2,
+            3: 3,
+        }
+
+        # Only road_id 2 has changed on the server:
+        data[2] = pd.DataFrame({"road_id": [2] * 4, "value": range(4)})
+        conn.requested = []
+        conn.pull(
+            "hsd_rough",
+            skip_existing=False,
+            incremental_download=True,
+            changed_only=True,
+        )
+        assert conn.requested == [2]
+        assert len(store.read("hsd_rough", road_ids=[2])) == 4
+
+    def test_pull_many(self, tmp_path, data):
+        from pyramm.store import SqliteStore
+
+        store = SqliteStore(tmp_path / "test.sqlite", database="test")
+        conn = self.FakeConnection(store, data)
+
+        # The first request for road_id 3 fails and is retried:
+        failures = {"3"}
+        get_page = conn._get_page
+
+        def flaky(table_name, filters, *args):
+            if filters and filters[0]["value"] in failures:
+                failures.remove(filters[0]["value"])
+                raise ConnectionError("server error")
+            return get_page(table_name, filters, *args)
+
+        conn._get_page = flaky
+        reports = []
+        failed = conn.pull_many(
+            ["hsd_rough", "hsd_texture"],
+            workers=2,
+            requests_per_second=1000,
+            progress=lambda pp: reports.append(str(pp)),
+        )
+        assert failed == []
+        assert len(reports) == 7
+        assert conn.rate_limiter is None
+        status = store.read_table_status()
+        assert status.loc[("test", "hsd_rough"), "full_retrieval"]
+        assert status.loc[("test", "hsd_texture"), "row_count"] == 6
+        assert len(store.read("hsd_rough", road_ids=[3])) == 3
+
+    def test_table_query_pages(self, tmp_path, data):
+        from pyramm.store import SqliteStore
+
+        conn = self.FakeConnection(SqliteStore(tmp_path / "test.sqlite"), data)
+        conn.chunk_size = 4
+        query = conn.table("hsd_rough").select(["value"])
+        assert query.plan()["source"] == "api"
+        pages = list(query.iter())
+        assert [len(pp) for pp in pages] == [4, 2]
+        assert list(pages[0].columns) == ["value"]
+
+    def test_table_query_iter_road_ids(self, tmp_path, data):
+        from pyramm.store import SqliteStore
+
+        conn = self.FakeConnection(SqliteStore(tmp_path / "test.sqlite"), data)
+        query = conn.table("hsd_rough").where(road_id=[1, 2, 3])
+        assert query.plan()["source"] == "api"
+        # The road_ids are requested in parallel, each with its own filters:
+        for _ in range(5):
+            pages = list(query.iter(threads=3))
+            assert [pp["road_id"].to_list() for pp in pages] == [[1], [2, 2], [3] * 3]
+
+    @pytest.mark.parametrize("store_type", ["sqlite", "parquet"])
+    def test_pull_streamed(self, tmp_path, data, store_type):
+        from pyramm.store import ParquetStore, SqliteStore, content_hash
+
+        if store_type == "sqlite":
+            store = SqliteStore(tmp_path / "test.sqlite", database="test")
+        else:
+            pytest.importorskip("pyarrow")
+            store = ParquetStore(tmp_path, database="test")
+        conn = self.FakeConnection(store, data)
+        # Pages of 2 rows, so the tables are written in several pages:
+        conn.chunk_size = 2
+
+        conn.pull("hsd_rough")
+        df = store.read("hsd_rough").sort_values(["road_id", "value"])
+        assert df["value"].to_list() == [0, 0, 1, 0, 1, 2]
+        status = store.read_road_id_status("hsd_rough")
+        assert status["row_count"].to_dict() == {1: 1, 2: 2, 3: 3}
+        assert status.loc[3, "content_hash"] == content_hash(data[3])
+
+        conn.pull("hsd_texture", incremental_download=True)
+        df = store.read("hsd_texture", road_ids=[3])
+        assert sorted(df["value"]) == [0, 1, 2]
+        status = store.read_road_id_status("hsd_texture")
+        assert status.loc[3, "content_hash"] == content_hash(data[3])
+
+    @pytest.mark.parametrize("store_type", ["sqlite", "parquet"])
+    def test_pull_failed_part_way(self, tmp_path, data, store_type):
+        from pyramm.store import ParquetStore, SqliteStore
+
+        if store_type == "sqlite":
+            store = SqliteStore(tmp_path / "test.sqlite", database="test")
+        else:
+            pytest.importorskip("pyarrow")
+            store = ParquetStore(tmp_path, database="test")
+        conn = self.FakeConnection(store, data)
+        conn.pull("hsd_rough")
+        assert store.read_table_status().loc[("test", "hsd_rough"), "full_retrieval"]
+
+        # Pages of 1 row, the third page of road_id 3 (and the entire table) fails:
+        conn.chunk_size = 1
+        get_page = conn._get_page
+
+        def failing(table_name, filters, get_geometry, skip, take):
+            if skip == 2 and (not filters or filters[0]["value"] == "3"):
+                raise ConnectionError("server error")
+            return get_page(table_name, filters, get_geometry, skip, take)
+
+        conn._get_page = failing
+        with pytest.raises(ConnectionError):
+            conn.pull("hsd_rough", skip_existing=False, road_ids=[3])
+        # The rows written before the failure are removed:
+        assert len(store.read("hsd_rough", road_ids=[3])) == 0
+        assert 3 not in store.read_road_id_status("hsd_rough").index
+        assert sorted(store.road_ids("hsd_rough")) == [1, 2]
+
+        with pytest.raises(ConnectionError):
+            conn.pull("hsd_rough", skip_existing=False)
+        # The table is no longer marked as complete:
+        status = store.read_table_status().loc[("test", "hsd_rough")]
+        assert not status["full_retrieval"]
+        assert len(store.read_road_id_status("hsd_rough")) == 0
+
+    def test_pull_null_first_page(self, tmp_path):
+        from pyramm.store import SqliteStore
+
+        store = SqliteStore(tmp_path / "test.sqlite", database="test")
+        # iri is all null in the first page (the API returns null values as None):
+        data = {
+            1: pd.DataFrame(
+                {
+                    "road_id": [1] * 4,
+                    "value": range(4),
+                    "iri": pd.Series([None, None, 1.5, 2.0], dtype=object),
+                }
+            )
+        }
+        conn = self.FakeConnection(store, data)
+        conn.chunk_size = 2
+        conn.pull("hsd_rough")
+        df = store.read("hsd_rough")
+        assert df["iri"].dtype == "float64"
+        assert df["iri"].to_list()[2:] == [1.5, 2.0]
+
+    def test_pull_many_single_writer(self, tmp_path, data):
+        import threading
+
+        from pyramm.store import SqliteStore
+
+        store = SqliteStore(tmp_path / "test.sqlite", database="test")
+        threads = set()
+        for name in ["replace_road_ids", "append", "update_road_id_status"]:
+
+            def record(*args, _write=getattr(store, name), **kwargs):
+                threads.add(threading.get_ident())
+                return _write(*args, **kwargs)
+
+            setattr(store, name, record)
+
+        conn = self.FakeConnection(store, data)
+        conn.chunk_size = 1
+        assert conn.pull_many(["hsd_rough", "hsd_texture"], workers=4) == []
+        # All the writes go through the single SQLite writer thread:
+        assert len(threads) == 1
+        assert threading.get_ident() not in threads
+
+    def test_pull_many_resume(self, tmp_path, data):
+        from pyramm.store import SqliteStore
+
+        store = SqliteStore(tmp_path / "test.sqlite", database="test")
+        conn = self.FakeConnection(store, data)
+        conn.chunk_size = 1
+        get_page = conn._get_page
+
+        # road_id 3 fails after its first two pages have been written:
+        def failing(table_name, filters, get_geometry, skip, take):
+            if filters and filters[0]["value"] == "3" and skip == 2:
+                raise ConnectionError("server error")
+            return get_page(table_name, filters, get_geometry, skip, take)
+
+        conn._get_page = failing
+        failed = conn.pull_many(["hsd_rough"], retries=0)
+        assert failed == [("hsd_rough", 3)]
+        assert not store.read_table_status().loc[
+            ("test", "hsd_rough"), "full_retrieval"
+        ]
+
+        # Resuming only pulls the failed road_id:
+        conn._get_page = get_page
+        conn.requested = []
+        assert conn.pull_many(["hsd_rough"]) == []
+        assert conn.requested == [3]
+        assert store.read_table_status().loc[("test", "hsd_rough"), "full_retrieval"]
+        assert sorted(store.read("hsd_rough", road_ids=[3])["value"]) == [0, 1, 2]
+        assert store.read_road_id_status("hsd_rough").loc[3, "row_count"] == 3
+
+
+def test_pull_progress():
+    from pyramm.jobs import PullProgress
+
+    progress = PullProgress(units_total=4)
+    assert progress.eta_s is None
+    progress.update(rows=10)
+    progress.update(failed=True)
+    assert (progress.units_done, progress.units_failed, progress.rows) == (1, 1, 10)
+    assert progress.eta_s is not None
+    assert str(progress).startswith("1/4 units (1 failed), 10 rows")
+
+
+@pytest.mark.parametrize("chunksize", [None, 2])
+def test_from_csv(tmp_path, chunksize):
+    from pyramm.tables import HsdRoughness, TableSchema
+
+    path = tmp_path / "hsd_rough.csv"
+    pd.DataFrame(
+        {
+            "survey_number": [1, 1, 2, 2, 3],
+            "road_id": [10, 10, 11, 11, 12],
+            "lane": ["L1", "R1", "L1", "L2", "R1"],
+            "start_m": [0, 10, 0, 10, 0],
+            "end_m": [10, 20, 10, 20, 10],
+            "iri": [1.5, None, 2.25, 3.0, 1.0],
+            "reading_date": ["2020-01-01"] * 5,
+            "comment": ["a", None, "b", "c", "d"],
+        }
+    ).to_csv(path, index=False)
+    schema = TableSchema.from_schema(
+        [
+            {"columnName": "road_id", "dataType": "Integer"},
+            {"columnName": "iri", "dataType": "Decimal", "decimalPlaces": 2},
+        ]
+    )
+
+    df = HsdRoughness.from_csv(
+        path,
+        usecols=["survey_number", "road_id", "lane", "start_m", "end_m", "iri"],
+        schema=schema,
+        chunksize=chunksize,
+    )
+    assert df.index.names == HsdRoughness.index_name
+    assert len(df) == 5
+    assert df["iri"].dtype == "float32"
+    assert df.index.get_level_values("lane").dtype == "category"
+    assert sorted(df.index.get_level_values("lane").categories) == ["L1", "L2", "R1"]
+
+
+def test_from_csv_to_store(tmp_path):
+    from pyramm.store import SqliteStore
+    from pyramm.tables import HsdRoughness
+
+    path = tmp_path / "hsd_rough.csv"
+    pd.DataFrame({"road_id": [10, 10, 11], "iri": [1.5, 2.0, 2.5]}).to_csv(
+        path, index=False
+    )
+    store = SqliteStore(tmp_path / "test.sqlite", database="test")
+    assert HsdRoughness.from_csv(path, chunksize=2, store=store) == 3
+    assert len(store.read("hsd_rough")) == 3
+    status = store.read_table_status().loc[("test", "hsd_rough")]
+    assert status["full_retrieval"] and status["row_count"] == 3
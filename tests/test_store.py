@@ -0,0 +1,115 @@
+import pandas as pd
+import pytest
+
+from pyramm.api import Connection
+from pyramm.store import ParquetStore, SqliteStore, content_hash
+
+
+@pytest.fixture(params=["sqlite", "parquet"])
+def store(request, tmp_path):
+    if request.param == "sqlite":
+        return SqliteStore(tmp_path / "test.sqlite", database="test")
+    return ParquetStore(tmp_path / "parquet", database="test")
+
+
+@pytest.fixture
+def df():
+    return pd.DataFrame(
+        {
+            "road_id": [1, 1, 2, 3],
+            "start_m": [0.0, 100.0, 0.0, 0.0],
+            "end_m": [100.0, 200.0, 50.0, 80.0],
+            "value": [10, 11, 20, 30],
+        }
+    )
+
+
+def test_store_write_and_read(store, df):
+    assert store.read("hsd_rough") is None
+    assert store.road_ids("hsd_rough") is None
+
+    store.write(df, "hsd_rough")
+    assert sorted(store.road_ids("hsd_rough")) == [1, 2, 3]
+
+    new = store.read("hsd_rough", columns=["road_id", "value"], road_ids=[1, 3])
+    assert list(new.columns) == ["road_id", "value"]
+    assert sorted(new["value"].to_list()) == [10, 11, 30]
+
+    new = store.read("hsd_rough", road_ids=[1], start_m=150)
+    assert new["value"].to_list() == [11]
+
+
+def test_store_replace_road_ids(store, df):
+    store.write(df, "hsd_rough")
+    store.replace_road_ids(
+        pd.DataFrame(
+            {"road_id": [2], "start_m": [0.0], "end_m": [60.0], "value": [21]}
+        ),
+        "hsd_rough",
+        [2, 3],
+    )
+    assert sorted(store.road_ids("hsd_rough")) == [1, 2]
+    assert sorted(store.read("hsd_rough")["value"].to_list()) == [10, 11, 21]
+
+
+def test_store_read_empty_road_id(store, df):
+    store.write(df.assign(latest="L"), "hsd_rough")
+    empty = store.read("hsd_rough", road_ids=[5])
+    assert len(empty) == 0
+    assert list(empty.columns) == ["road_id", "start_m", "end_m", "value", "latest"]
+
+    # The filters can be applied to a road_id without any rows:
+    conn = Connection.local(store=store)
+    assert len(conn.get_data("hsd_rough", road_id=5, latest=True)) == 0
+    query = conn.table("hsd_rough").where(road_id=[1, 5], latest=True)
+    assert [len(pp) for pp in query.iter()] == [2, 0]
+
+
+def test_store_null_road_ids(store, df):
+    # Rows without a road_id are kept:
+    df.loc[4] = [None, 0.0, 10.0, 40]
+    store.write(df, "hsd_rough")
+    assert set(store.road_ids("hsd_rough")) == {1, 2, 3, None}
+    assert sorted(store.read("hsd_rough")["value"].to_list()) == [10, 11, 20, 30, 40]
+
+    store.append(df.iloc[[4]], "hsd_rough")
+    store.replace_road_ids(df.iloc[[0]], "hsd_rough", [1])
+    assert sorted(store.read("hsd_rough")["value"].to_list()) == [10, 20, 30, 40, 40]
+
+
+def test_store_table_status(store):
+    assert store.read_table_status() is None
+    store.update_table_status("hsd_rough", True)
+    store.update_table_status("roadnames", False)
+    table_status = store.read_table_status()
+    assert bool(table_status.loc[("test", "hsd_rough"), "full_retrieval"])
+    assert not bool(table_status.loc[("test", "roadnames"), "full_retrieval"])
+
+
+def test_store_road_id_status(store):
+    assert store.read_road_id_status("hsd_rough") is None
+    store.update_road_id_status(
+        "hsd_rough",
+        [
+            {"road_id": 1, "row_count": 2, "content_hash": "a"},
+            {"road_id": 2, "row_count": 3, "content_hash": "b"},
+        ],
+    )
+    store.update_road_id_status(
+        "hsd_rough", [{"road_id": 2, "row_count": 4, "content_hash": "c"}]
+    )
+    status = store.read_road_id_status("hsd_rough")
+    assert status["row_count"].to_dict() == {1: 2, 2: 4}
+    assert status["content_hash"].to_dict() == {1: "a", 2: "c"}
+
+    store.update_road_id_status(
+        "hsd_rough",
+        [{"road_id": 3, "row_count": 1, "content_hash": "d"}],
+        replace_all=True,
+    )
+    assert store.read_road_id_status("hsd_rough").index.to_list() == [3]
+
+
+def test_content_hash(df):
+    assert content_hash(df) == content_hash(df.iloc[::-1])
+    assert content_hash(df) != content_hash(df.assign(value=df["value"] + 1))